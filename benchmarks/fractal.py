@@ -0,0 +1,62 @@
+"""
+Benchmark of the fractal renderer.
+
+Measures how many fractals per second are rendered, PNG encoding
+included, at the size used by `!fractal`: first in one process, then
+split in tiles rendered by a pool of worker processes.
+
+Run with:
+    python benchmarks/fractal.py [size] [number of renders] [workers]
+"""
+
+import asyncio
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+from time import perf_counter
+
+# Import the module directly, importing src needs a discord token.
+sys.path.append(str(Path(__file__).parent.parent / "src" / "cogs"))
+from _fractal import FRACTAL_SIZE, render_fractal, render_fractal_tiled
+
+
+def report(name, size, renders, elapsed):
+    print(
+        f"{name}: {renders} renders at {size}px in {elapsed:.2f}s, "
+        f"{renders / elapsed:.2f} renders/s, {elapsed / renders * 1000:.0f}ms/render"
+    )
+
+
+def single(size, renders):
+    render_fractal("warmup", size)
+
+    start = perf_counter()
+    for i in range(renders):
+        render_fractal(f"benchmark {i}", size)
+    report("1 process", size, renders, perf_counter() - start)
+
+
+async def tiled(size, renders, workers):
+    loop = asyncio.get_event_loop()
+    with ProcessPoolExecutor(workers) as pool:
+
+        async def run(f, *args):
+            return await loop.run_in_executor(pool, partial(f, *args))
+
+        await render_fractal_tiled("warmup", run, size)
+
+        start = perf_counter()
+        for i in range(renders):
+            await render_fractal_tiled(f"benchmark {i}", run, size)
+        report(f"{workers} workers, tiled", size, renders, perf_counter() - start)
+
+
+def main(size=FRACTAL_SIZE, renders=20, workers=os.cpu_count()):
+    single(size, renders)
+    asyncio.run(tiled(size, renders, workers))
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,116 @@
+"""
+Benchmark of the hug leaderboard on a synthetic log.
+
+Compares recomputing the leaderboard from the whole log, like
+`!hug-stats` used to do, with the incremental HugLeaderboard,
+in exact and approximate mode.
+
+Run with:
+    python benchmarks/hug_leaderboard.py [number of hugs]
+"""
+
+import random
+import sys
+import tracemalloc
+from collections import Counter, defaultdict
+from operator import itemgetter
+from pathlib import Path
+from time import perf_counter
+
+# Import the module directly, importing src needs a discord token.
+sys.path.append(str(Path(__file__).parent.parent / "src" / "cogs"))
+from _hugs import Hug, HugLeaderboard
+
+EVERYONE = 1
+MEMBERS = 5000
+ROLES = {2: range(100, 400), 3: range(1000, 1050)}
+TOP = 13
+
+
+def synthetic_log(n, seed=42):
+    rng = random.Random(seed)
+    members = range(100, 100 + MEMBERS)
+    # Some members hug a lot more than others
+    weights = [1 / (i + 1) for i in range(MEMBERS)]
+    huggers = rng.choices(members, weights, k=n)
+    hugged = rng.choices(members, weights, k=n)
+    for i in range(n):
+        r = rng.random()
+        if r < 0.05:
+            hugged[i] = EVERYONE
+        elif r < 0.06:
+            hugged[i] = rng.choice(list(ROLES))
+    return [Hug(a, b, "") for a, b in zip(huggers, hugged)]
+
+
+def recompute(hugs):
+    """The algorithm !hug-stats used before HugLeaderboard."""
+    everyone_hugs = 0
+    everyone_diff = set()
+    stats = Counter()
+    diffs = defaultdict(set)
+    for h in hugs:
+        if h.hugged == EVERYONE:
+            everyone_hugs += 1
+            everyone_diff.add(h.hugger)
+        else:
+            if h.hugged != h.hugger:
+                stats[h.hugged] += 1
+                diffs[h.hugged].add(h.hugger)
+            for m in ROLES.get(h.hugged, ()):
+                if m != h.hugger:
+                    stats[m] += 1
+                    diffs[m].add(h.hugger)
+
+    for m, d in diffs.items():
+        stats[m] += len(everyone_diff.union(d)) * 42 + everyone_hugs
+
+    return sorted(stats.items(), key=itemgetter(1), reverse=True)[:TOP]
+
+
+def timed(f, *args):
+    start = perf_counter()
+    result = f(*args)
+    return result, perf_counter() - start
+
+
+def main(n):
+    hugs = synthetic_log(n)
+    extra = synthetic_log(10_000, seed=1)
+    print(f"{n} hugs, {MEMBERS} members")
+
+    expected, t = timed(recompute, hugs)
+    print(f"Full recompute:          {t * 1000:10.1f} ms per !hug-stats")
+
+    for approximate in (False, True):
+        print("Approximate" if approximate else "Exact")
+
+        board = HugLeaderboard(EVERYONE, lambda id_: ROLES.get(id_), approximate)
+        _, t = timed(board.extend, hugs)
+        print(f"  first build: {t * 1000:10.1f} ms, once")
+
+        top, t = timed(board.top, TOP)
+        print(f"  top {TOP}:      {t * 1000:10.1f} ms for the first one")
+        top, t = timed(board.top, TOP)
+        print(f"  top {TOP}:      {t * 1e6:10.1f} µs per !hug-stats")
+        if approximate:
+            error = max(abs(a[1] - b[1]) / b[1] for a, b in zip(top, expected))
+            print(f"  max error:   {error * 100:10.1f} % on the top {TOP}")
+        else:
+            assert [s for _, s in top] == [s for _, s in expected]
+
+        _, t = timed(lambda: [board.add(h) for h in extra])
+        print(f"  add_hug:     {t / len(extra) * 1e6:10.1f} µs per hug")
+
+        # Measured separately, tracing allocations is slow
+        tracemalloc.start()
+        board = HugLeaderboard(EVERYONE, lambda id_: ROLES.get(id_), approximate)
+        board.extend(hugs)
+        board.top(TOP)
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print(f"  memory:      {memory / 2 ** 20:10.1f} MiB")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
@@ -0,0 +1,561 @@
+"""
+Evaluation of the calculations of MiscCog, in worker processes.
+
+This file is prefixed with a _ to avoid loading it as an extension.
+"""
+
+import ast
+import io
+import math
+import operator as op
+import re
+import resource
+import sys
+import traceback
+from collections import OrderedDict
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache, wraps
+from math import factorial
+from typing import Any, Callable, Dict, NamedTuple, Optional, Tuple
+
+import numpy as np
+import psutil
+from engine import worker_pool, WorkTimeout
+from PIL import Image, ImageDraw
+
+# supported operators
+OPS = {
+    ast.Add: op.add,
+    ast.Sub: op.sub,
+    ast.Mult: op.mul,
+    ast.FloorDiv: op.floordiv,
+    ast.Mod: op.mod,
+    ast.Div: op.truediv,
+    ast.Pow: op.pow,
+    ast.MatMult: op.matmul,
+    ast.BitXor: op.xor,
+    ast.USub: op.neg,
+    "abs": abs,
+    "π": math.pi,
+    "τ": math.tau,
+    "i": 1j,
+    "fact": factorial,
+}
+
+
+def vectorized(scalar, vector):
+    """Use the vector version of the function when an argument is an array."""
+
+    @wraps(scalar)
+    def f(*args, **kwargs):
+        if any(isinstance(a, np.ndarray) for a in args):
+            return vector(*args, **kwargs)
+        return scalar(*args, **kwargs)
+
+    return f
+
+
+for name in dir(math):
+    if not name.startswith("_"):
+        f = getattr(math, name)
+        if isinstance(getattr(np, name, None), np.ufunc):
+            f = vectorized(f, getattr(np, name))
+        OPS[name] = f
+
+OPS["abs"] = vectorized(abs, np.abs)
+OPS.update(
+    linspace=np.linspace,
+    arange=np.arange,
+    zeros=np.zeros,
+    ones=np.ones,
+    eye=np.eye,
+    sum=np.sum,
+    mean=np.mean,
+    std=np.std,
+    min=np.min,
+    max=np.max,
+    dot=np.dot,
+    transpose=np.transpose,
+    norm=np.linalg.norm,
+    det=np.linalg.det,
+    inv=np.linalg.inv,
+    solve=np.linalg.solve,
+)
+
+CALC_TIMEOUT = 3
+"""Seconds a calculation can run before its worker is killed."""
+CALC_MEMORY = 256 * 2 ** 20
+"""Bytes a worker can allocate on top of what it inherits."""
+MAX_DIGITS = 100_000
+"""Calculations whose result may have more digits are not run."""
+FLOAT_DIGITS = math.log10(sys.float_info.max)
+MAX_ELEMENTS = CALC_MEMORY // 16
+"""Arrays with more elements may not fit in the memory of a worker."""
+FACTORIALS = {"fact", "factorial", "comb", "perm"}
+"""Functions whose result has about n log(n) digits."""
+CACHE_SIZE = 1024
+ARRAY_THRESHOLD = 60
+"""Arrays with more elements are summarised by their first and last ones."""
+PLOT_RE = re.compile(
+    r"^(?P<expr>.+),\s*(?P<var>[^\W\d]\w*)\s*=\s*(?P<start>.+?)\s*\.\.\s*(?P<end>.+)$"
+)
+PLOT_POINTS = 2000
+PLOT_SIZE = (800, 500)
+PLOT_MARGIN = 40
+PLOT_COLOR = (138, 43, 226)
+IMPLICIT_MUL_RE = re.compile(r"\b((\d)+(\.\d+)?)(?P<name>[a-zA-Z]+)\b")
+
+
+class CalcResult(NamedTuple):
+    value: str
+    error: Optional[str] = None
+    trace: Optional[str] = None
+    image: Optional[bytes] = None
+    """PNG data of a plot."""
+
+
+class TooExpensive(Exception):
+    pass
+
+
+def normalize(query: str) -> str:
+    """Make implicit multiplications explicit and remove code quotes."""
+
+    query = IMPLICIT_MUL_RE.sub(r"\1*\4", query)
+    return query.strip().strip("`")
+
+
+Compiled = Tuple[Callable[[Dict[str, Any]], Any], bool]
+"""A function of the variables, and whether it is constant."""
+
+
+def constant(value) -> Compiled:
+    return (lambda env: value), True
+
+
+def compile_node(node) -> Compiled:
+    """
+    Compile the node into a function of the variables.
+
+    Operations whose operands are constant are computed once, here.
+    """
+
+    if isinstance(node, ast.Num):  # <number>
+        return constant(node.n)
+    elif isinstance(node, ast.BinOp):  # <left> <operator> <right>
+        f = OPS[type(node.op)]
+        left, left_constant = compile_node(node.left)
+        right, right_constant = compile_node(node.right)
+        if left_constant and right_constant:
+            return constant(f(left({}), right({})))
+        return (lambda env: f(left(env), right(env))), False
+    elif isinstance(node, ast.UnaryOp):  # <operator> <operand> e.g., -1
+        f = OPS[type(node.op)]
+        operand, is_constant = compile_node(node.operand)
+        if is_constant:
+            return constant(f(operand({})))
+        return (lambda env: f(operand(env))), False
+    elif isinstance(node, ast.Call):
+        if isinstance(node.func, ast.Name):
+            f = OPS[node.func.id]
+            args = [compile_node(n) for n in node.args]
+            kwargs = {k.arg: compile_node(k.value) for k in node.keywords}
+
+            def call(env):
+                return f(
+                    *(a(env) for a, _ in args),
+                    **{k: a(env) for k, (a, _) in kwargs.items()},
+                )
+
+            if all(c for _, c in args + list(kwargs.values())):
+                return constant(call({}))
+            return call, False
+    elif isinstance(node, ast.List):  # [<element>, ...]
+        elements = [compile_node(n) for n in node.elts]
+
+        def array(env):
+            return np.array([e(env) for e, _ in elements])
+
+        if all(c for _, c in elements):
+            return constant(array({}))
+        return array, False
+    elif isinstance(node, ast.Name):
+        if node.id in OPS:
+            return constant(OPS[node.id])
+        name = node.id
+        return (lambda env: env[name]), False
+
+    fields = ", ".join(
+        f"{k}={getattr(node, k).__class__.__name__}" for k in node._fields
+    )
+    raise TypeError(f"Node type not supported: {node.__class__.__name__}({fields})")
+
+
+def estimate_digits(node) -> float:
+    """
+    Upper bound of the number of digits of the value of the node.
+
+    This is a quick static estimate, used to reject calculations like
+    9**9**9 or fact(10**7) before running them. Functions returning floats
+    have at most FLOAT_DIGITS, since larger floats raise an OverflowError.
+    """
+
+    if isinstance(node, ast.Num):
+        value = abs(node.n)
+        return math.log10(value) if value > 1 else 0
+    elif isinstance(node, ast.BinOp):
+        left = estimate_digits(node.left)
+        right = estimate_digits(node.right)
+        if isinstance(node.op, (ast.Add, ast.Sub, ast.BitXor)):
+            return max(left, right) + 1
+        elif isinstance(node.op, (ast.Mult, ast.MatMult)):
+            return left + right
+        elif isinstance(node.op, ast.Pow):
+            return left * 10 ** min(right, 300)
+        elif isinstance(node.op, ast.Div):
+            return min(left, FLOAT_DIGITS)
+        return left
+    elif isinstance(node, ast.UnaryOp):
+        return estimate_digits(node.operand)
+    elif isinstance(node, ast.List):
+        return max([estimate_digits(n) for n in node.elts] + [0])
+    elif isinstance(node, ast.Call):
+        args = [estimate_digits(n) for n in node.args]
+        name = getattr(node.func, "id", None)
+        if name in FACTORIALS and args:
+            n = 10 ** min(args[0], 300)
+            return n * math.log10(n)
+        return max(args + [FLOAT_DIGITS])
+    return 1
+
+
+def static_value(node) -> Optional[float]:
+    """
+    Magnitude of the value of a node made only of small numbers and operators,
+    or None when it cannot be known without running the calculation.
+    """
+
+    operators = (ast.operator, ast.unaryop)
+    for n in ast.walk(node):
+        if not isinstance(n, (ast.Num, ast.BinOp, ast.UnaryOp) + operators):
+            return None
+        if not isinstance(n, operators) and estimate_digits(n) > 18:
+            return None
+    try:
+        function, _ = compile_node(node)
+        return abs(function({}))
+    except Exception:
+        return None
+
+
+def bound(node) -> float:
+    """Upper bound of the magnitude of the value of the node."""
+
+    value = static_value(node)
+    if value is None:
+        return 10 ** min(estimate_digits(node), 300)
+    return value
+
+
+def estimate_elements(node) -> float:
+    """
+    Upper bound of the number of elements of the arrays made by the node.
+
+    This is a quick static estimate, used to reject calculations like
+    zeros(10**9) or eye(10**6) before they run out of memory: the size of
+    arrays made by the NumPy constructors is computed from their arguments.
+    Variables are the PLOT_POINTS of a plot.
+    """
+
+    if isinstance(node, ast.Name):
+        return 1 if node.id in OPS else PLOT_POINTS
+    elif isinstance(node, ast.BinOp):
+        return max(estimate_elements(node.left), estimate_elements(node.right))
+    elif isinstance(node, ast.UnaryOp):
+        return estimate_elements(node.operand)
+    elif isinstance(node, ast.List):
+        return sum(estimate_elements(n) for n in node.elts)
+    elif isinstance(node, ast.Call):
+        kwargs = {k.arg: k.value for k in node.keywords}
+        inner = [estimate_elements(n) for n in node.args + list(kwargs.values())]
+        name = getattr(node.func, "id", None)
+
+        def arg(i, key, default=None):
+            return node.args[i] if len(node.args) > i else kwargs.get(key, default)
+
+        size = 1
+        if name in ("zeros", "ones") and arg(0, "shape"):
+            shape = arg(0, "shape")
+            dims = shape.elts if isinstance(shape, ast.List) else [shape]
+            size = np.prod([bound(d) for d in dims], dtype=float)
+        elif name == "eye" and arg(0, "N"):
+            size = bound(arg(0, "N")) * bound(arg(1, "M", arg(0, "N")))
+        elif name == "linspace":
+            num = arg(2, "num")
+            size = 50 if num is None else bound(num)
+        elif name == "arange" and node.args:
+            if len(node.args) == 1:
+                size = bound(node.args[0])
+            else:
+                start, stop = (static_value(n) for n in node.args[:2])
+                step = static_value(node.args[2]) if len(node.args) > 2 else 1
+                if None not in (start, stop, step) and step:
+                    size = (start + stop) / step
+        return max(inner + [size])
+    return 1
+
+
+def format_result(result) -> str:
+    if isinstance(result, np.ndarray):
+        return format_array(result)
+    if isinstance(result, np.generic):
+        result = result.item()
+    if isinstance(result, complex):
+        if abs(result.imag) < 1e-12:
+            result = result.real
+        else:
+            r, i = result.real, result.imag
+            r = r if abs(int(r) - r) > 1e-12 else int(r)
+            i = i if abs(int(i) - i) > 1e-12 else int(i)
+            if not r:
+                result = f"{i if i != 1 else ''}i"
+            else:
+                result = f"{r}{i if i != 1 else '':+}i"
+    if isinstance(result, float):
+        result = round(result, 12)
+    return str(result)
+
+
+def format_array(array: np.ndarray) -> str:
+    text = np.array2string(
+        array,
+        threshold=ARRAY_THRESHOLD,
+        edgeitems=3,
+        precision=6,
+        suppress_small=True,
+        max_line_width=60,
+    )
+    if array.size > ARRAY_THRESHOLD:
+        shape = "×".join(map(str, array.shape))
+        text = f"{shape} {array.dtype}\n{text}"
+    return text
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def parse_query(query: str) -> ast.expr:
+    """
+    Parse a query, with a cache.
+
+    Only the syntax tree is cached: the folded constants may be huge
+    arrays or integers, and the results are cached by CalcCache.
+    """
+
+    return ast.parse(query, mode="eval").body
+
+
+def check_cost(query: str):
+    """Raise TooExpensive if the result of the query or its arrays may be too large."""
+
+    node = parse_query(query)
+    if estimate_digits(node) > MAX_DIGITS:
+        raise TooExpensive("The result would have too many digits.")
+    if estimate_elements(node) > MAX_ELEMENTS:
+        raise TooExpensive("The arrays would not fit in memory.")
+
+
+def compile_query(query: str) -> Compiled:
+    return compile_node(parse_query(query))
+
+
+def evaluate_constant(query: str):
+    function, is_constant = compile_query(query)
+    if not is_constant:
+        raise NameError("Unknown variables in the expression.")
+    return function({})
+
+
+def error_result(ex: Exception) -> CalcResult:
+    trace = io.StringIO()
+    traceback.print_exception(type(ex), ex, ex.__traceback__, file=trace)
+    return CalcResult("42", f"{ex.__class__.__name__}: {ex}", trace.getvalue())
+
+
+def calc(query: str) -> CalcResult:
+    """Evaluate a normalized query. This runs in a worker process."""
+
+    try:
+        return CalcResult(format_result(evaluate_constant(query)))
+    except Exception as ex:
+        return error_result(ex)
+
+
+def plot(query: str) -> CalcResult:
+    """
+    Plot a normalized query like "sin(x)/x, x=-10..10" in a PNG image.
+
+    The expression is evaluated once on the whole grid of PLOT_POINTS,
+    as an array. This runs in a worker process.
+    """
+
+    try:
+        match = PLOT_RE.match(query)
+        if match is None:
+            raise SyntaxError("Expected: <expression>, x=<start>..<end>")
+        start = float(np.real(evaluate_constant(match["start"])))
+        end = float(np.real(evaluate_constant(match["end"])))
+        xs = np.linspace(start, end, PLOT_POINTS)
+
+        function, _ = compile_query(match["expr"])
+        with np.errstate(all="ignore"):
+            ys = np.real(function({match["var"]: xs}))
+            ys = np.broadcast_to(ys, xs.shape).astype(float)
+
+        defined = np.isfinite(ys).sum()
+        return CalcResult(
+            f"{defined}/{PLOT_POINTS} points defined", image=render_plot(xs, ys)
+        )
+    except Exception as ex:
+        return error_result(ex)
+
+
+def render_plot(xs: np.ndarray, ys: np.ndarray) -> bytes:
+    finite = np.isfinite(ys)
+    if not finite.any():
+        raise ValueError("The expression is not defined on this interval.")
+
+    # Percentiles keep the shape visible around poles, like in tan(x)
+    low, high = np.percentile(ys[finite], [0.5, 99.5])
+    pad = (high - low) * 0.1 or 1
+    low, high = low - pad, high + pad
+
+    width, height = PLOT_SIZE
+    left, top = PLOT_MARGIN, PLOT_MARGIN // 2
+    right, bottom = width - PLOT_MARGIN // 2, height - PLOT_MARGIN
+
+    def to_px(x, y):
+        px = left + (x - xs[0]) / (xs[-1] - xs[0] or 1) * (right - left)
+        py = bottom - (y - low) / (high - low) * (bottom - top)
+        return px, np.clip(py, -height, 2 * height)
+
+    img = Image.new("RGB", PLOT_SIZE, "white")
+    draw = ImageDraw.Draw(img)
+
+    x0, y0 = to_px(0, 0)
+    if left < x0 < right:
+        draw.line([(x0, top), (x0, bottom)], fill="lightgray")
+    if top < y0 < bottom:
+        draw.line([(left, y0), (right, y0)], fill="lightgray")
+
+    pxs, pys = to_px(xs, ys)
+    # Draw each run of consecutive finite points as one line
+    breaks = np.flatnonzero(np.diff(finite.astype(np.int8))) + 1
+    for run in np.split(np.arange(len(xs)), breaks):
+        if finite[run[0]]:
+            points = list(zip(pxs[run].tolist(), pys[run].tolist()))
+            if len(points) > 1:
+                draw.line(points, fill=PLOT_COLOR, width=2)
+            else:
+                draw.point(points, fill=PLOT_COLOR)
+
+    # Hide what goes out of the frame
+    draw.rectangle([(0, 0), (width, top)], fill="white")
+    draw.rectangle([(0, bottom), (width, height)], fill="white")
+    draw.rectangle([(left, top), (right, bottom)], outline="black")
+    draw.text((left, bottom + 4), f"{xs[0]:.4g}", fill="black")
+    draw.text((right - 40, bottom + 4), f"{xs[-1]:.4g}", fill="black")
+    draw.text((2, top), f"{high:.3g}", fill="black")
+    draw.text((2, bottom - 12), f"{low:.3g}", fill="black")
+
+    out = io.BytesIO()
+    img.save(out, "PNG", optimize=True)
+    return out.getvalue()
+
+
+def _init_worker(extra_memory: int):
+    inherited = psutil.Process().memory_info().vms
+    limit = inherited + extra_memory
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    if hasattr(sys, "set_int_max_str_digits"):
+        # Results are bounded by MAX_DIGITS already
+        sys.set_int_max_str_digits(0)
+
+
+class CalcCache:
+    """The most recently used results of calculations, with hit counters."""
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.results: Dict[str, CalcResult] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.results)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
+
+    def get(self, query: str) -> Optional[CalcResult]:
+        result = self.results.get(query)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.results.move_to_end(query)
+        return result
+
+    def put(self, query: str, result: CalcResult):
+        self.results[query] = result
+        self.results.move_to_end(query)
+        if len(self.results) > self.size:
+            self.results.popitem(last=False)
+
+
+class CalcSandbox:
+    """
+    Run calculations in the "calc" worker pool.
+
+    Each worker can only allocate CALC_MEMORY more bytes, and when a
+    calculation runs longer than CALC_TIMEOUT its worker is killed and
+    replaced.
+
+    Since all the operations are pure, the results of calculations that
+    succeed are cached, with the normalized query as key.
+    """
+
+    def __init__(self, workers=2):
+        self.pool = worker_pool(
+            "calc", workers, initializer=_init_worker, initargs=(CALC_MEMORY,)
+        )
+        self.cache = CalcCache()
+
+    async def run(self, query: str) -> CalcResult:
+        result = self.cache.get(query)
+        if result is None:
+            result = await self._run(query)
+            if result.error is None:
+                self.cache.put(query, result)
+        return result
+
+    async def plot(self, query: str) -> CalcResult:
+        """Plot a query like "sin(x)/x, x=-10..10". Plots are not cached."""
+
+        match = PLOT_RE.match(query)
+        return await self._run(query, plot, match["expr"] if match else query)
+
+    async def _run(self, query: str, function=calc, expression=None) -> CalcResult:
+        try:
+            check_cost(expression or query)
+        except TooExpensive as e:
+            return CalcResult("Too long to compute.", f"TooExpensive: {e}")
+        except Exception:
+            pass  # The worker reports syntax errors.
+
+        try:
+            return await self.pool.run(function, query, timeout=CALC_TIMEOUT)
+        except WorkTimeout as e:
+            return CalcResult("Too long to compute.", e.message)
+        except BrokenProcessPool:
+            return CalcResult("42", "The calculation was interrupted.")
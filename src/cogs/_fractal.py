@@ -0,0 +1,325 @@
+"""
+Rendering and scheduling of the fractals of MiscCog.
+
+This file is prefixed with a _ to avoid loading it as an extension.
+"""
+
+import asyncio
+import hashlib
+import io
+from collections import deque, OrderedDict
+from multiprocessing.shared_memory import SharedMemory
+from time import monotonic
+from typing import Any, Awaitable, Callable, Deque, Dict, List, NamedTuple, Optional
+
+import numpy as np
+from PIL import Image
+
+FRACTAL_SIZE = 640
+MAX_ITERATIONS = 256
+TILE_ROWS = 32
+"""Height of the bands of the image rendered in parallel."""
+ESCAPE_RADIUS = 256.0
+
+
+class FractalParams(NamedTuple):
+    """Everything needed to draw a Julia set, derived from a seed."""
+
+    c: complex
+    center: complex
+    zoom: float
+    rotation: complex
+    palette: np.ndarray
+    """Cosine palette (Inigo Quilez), shape (4, 3): a + b cos(2π(c t + d))."""
+
+    @classmethod
+    def from_seed(cls, seed: str) -> "FractalParams":
+        digest = hashlib.sha256(seed.encode()).digest()
+        rng = np.random.default_rng(int.from_bytes(digest, "little"))
+
+        # Julia sets of points just outside the main cardioid of the
+        # Mandelbrot set have a lot of details and few points inside.
+        angle = rng.uniform(0, 2 * np.pi)
+        point = np.exp(1j * angle) / 2 - np.exp(2j * angle) / 4
+        c = point * rng.uniform(1.0, 1.04)
+
+        palette = np.array(
+            [
+                rng.uniform(0.3, 0.7, 3),
+                rng.uniform(0.3, 0.5, 3),
+                rng.choice([0.5, 1.0, 2.0], 3),
+                rng.uniform(0, 1, 3),
+            ]
+        )
+        return cls(
+            complex(c),
+            complex(*rng.uniform(-0.2, 0.2, 2)),
+            rng.uniform(0.8, 1.4),
+            complex(np.exp(1j * rng.uniform(0, 2 * np.pi))),
+            palette,
+        )
+
+
+def render_rows(params: FractalParams, size: int, start: int, stop: int) -> np.ndarray:
+    """
+    Render the rows [start, stop) of the image, as an RGB array.
+
+    The escape-time iteration runs on all the pixels at once, as arrays,
+    and only on the points that have not escaped yet.
+    """
+
+    half = size / 2
+    ys, xs = np.mgrid[start:stop, 0:size]
+    z = ((xs - half) + 1j * (ys - half)) / (half * params.zoom / 1.5)
+    z = (z * params.rotation + params.center).ravel()
+
+    smooth = np.zeros(z.shape)
+    inside = np.ones(z.shape, bool)
+    index = np.arange(z.size)
+    c = params.c
+
+    for i in range(MAX_ITERATIONS):
+        np.multiply(z, z, out=z)
+        z += c
+        modulus = np.abs(z)
+        escaped = modulus > ESCAPE_RADIUS
+        if escaped.any():
+            # Smooth iteration count, to avoid color bands
+            smooth[index[escaped]] = i + 1 - np.log2(np.log(modulus[escaped]))
+            inside[index[escaped]] = False
+            # Only keep iterating on the points that have not escaped
+            z, index = z[~escaped], index[~escaped]
+            if not z.size:
+                break
+
+    t = np.sqrt(np.maximum(smooth, 0) / MAX_ITERATIONS)[:, None]
+    a, b, freq, phase = params.palette
+    colors = a + b * np.cos(2 * np.pi * (freq * t + phase))
+    colors[inside] = 0
+    colors = (np.clip(colors, 0, 1) * 255).astype(np.uint8)
+    return colors.reshape(stop - start, size, 3)
+
+
+def render_fractal(seed: str, size=FRACTAL_SIZE) -> bytes:
+    """Render the fractal of the seed as a PNG. This is CPU-bound."""
+
+    params = FractalParams.from_seed(seed)
+    pixels = render_rows(params, size, 0, size)
+    out = io.BytesIO()
+    Image.fromarray(pixels).save(out, "PNG")
+    return out.getvalue()
+
+
+def _attach(name: str) -> SharedMemory:
+    """Open a shared memory block created, and unlinked, by another process."""
+
+    try:
+        return SharedMemory(name, track=False)  # Python 3.13+
+    except TypeError:
+        # Workers share the resource tracker of their parent, which
+        # already tracks the block
+        return SharedMemory(name)
+
+
+def render_tile(shm_name: str, params: FractalParams, size: int, start: int, stop: int):
+    """Render rows [start, stop) straight into the shared pixel buffer."""
+
+    shm = _attach(shm_name)
+    try:
+        pixels = np.ndarray((size, size, 3), np.uint8, shm.buf)
+        pixels[start:stop] = render_rows(params, size, start, stop)
+        del pixels  # The buffer cannot be closed while it is used
+    finally:
+        shm.close()
+
+
+def encode_png(shm_name: str, size: int) -> bytes:
+    shm = _attach(shm_name)
+    try:
+        pixels = np.ndarray((size, size, 3), np.uint8, shm.buf)
+        out = io.BytesIO()
+        Image.fromarray(pixels).save(out, "PNG")
+        del pixels
+        return out.getvalue()
+    finally:
+        shm.close()
+
+
+async def render_fractal_tiled(
+    seed: str, run: Callable[..., Awaitable], size=FRACTAL_SIZE
+) -> bytes:
+    """
+    Render the fractal of the seed as a PNG, using many worker processes.
+
+    The image is split in bands of TILE_ROWS rows, and each band is
+    rendered by `run(f, *args)`, usually the run method of a process pool,
+    directly into a shared memory buffer, so pixels are never pickled.
+    The PNG is then encoded from that buffer, in a worker too.
+    """
+
+    params = FractalParams.from_seed(seed)
+    shm = SharedMemory(create=True, size=size * size * 3)
+    try:
+        bands = [
+            (start, min(start + TILE_ROWS, size)) for start in range(0, size, TILE_ROWS)
+        ]
+        await asyncio.gather(
+            *(run(render_tile, shm.name, params, size, a, b) for a, b in bands)
+        )
+        return await run(encode_png, shm.name, size)
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+class TokenBucket:
+    """Allow `capacity` actions at once, then one every `period` seconds."""
+
+    def __init__(self, capacity: int, period: float):
+        self.capacity = capacity
+        self.period = period
+        self.tokens = float(capacity)
+        self.updated = monotonic()
+
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) / self.period
+        )
+        self.updated = now
+
+    def ready_in(self, n=1) -> float:
+        """Seconds until n tokens are available."""
+
+        self._refill()
+        return max(0.0, (n - self.tokens) * self.period)
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+
+class QueueFull(Exception):
+    pass
+
+
+class FractalJob(NamedTuple):
+    guild_id: Optional[int]
+    user_id: int
+    seed: str
+    ctx: Any
+
+
+class FairQueue:
+    """
+    Fractal jobs, served in turn to each guild, then to each user of a guild.
+
+    Each user has a token bucket, and their jobs wait for a token, while
+    the jobs of the other users can start. A user can have at most
+    max_pending jobs waiting.
+    """
+
+    def __init__(self, burst: int, cooldown: float, max_pending: int):
+        self.burst = burst
+        self.cooldown = cooldown
+        self.max_pending = max_pending
+        self.guilds: Dict[Optional[int], Dict[int, Deque[FractalJob]]] = OrderedDict()
+        """self.guilds[guild_id][user_id] = the jobs of the user, in order"""
+        self.buckets: Dict[int, TokenBucket] = {}
+        self.changed = asyncio.Event()
+
+    def __len__(self):
+        return sum(
+            len(jobs) for users in self.guilds.values() for jobs in users.values()
+        )
+
+    def bucket(self, user_id: int) -> TokenBucket:
+        if user_id not in self.buckets:
+            self.buckets[user_id] = TokenBucket(self.burst, self.cooldown)
+        return self.buckets[user_id]
+
+    def pending(self, user_id: int) -> List[FractalJob]:
+        """The jobs of the user that are waiting, in order."""
+        return [job for job in self.order() if job.user_id == user_id]
+
+    def put(self, job: FractalJob) -> int:
+        """
+        Add a job and return its position in the queue, starting at 1.
+
+        Raises QueueFull when the user already has max_pending jobs waiting.
+        """
+
+        if len(self.pending(job.user_id)) >= self.max_pending:
+            raise QueueFull(
+                f"You already have {self.max_pending} fractals waiting, "
+                "wait for them to be drawn."
+            )
+
+        users = self.guilds.setdefault(job.guild_id, OrderedDict())
+        users.setdefault(job.user_id, deque()).append(job)
+        self.changed.set()
+        return self.order().index(job) + 1
+
+    def ready_in(self, job: FractalJob) -> float:
+        """
+        Seconds until the job can start at the earliest, as each of the jobs
+        of its user before it takes a token.
+        """
+
+        ahead = self.pending(job.user_id).index(job)
+        return self.bucket(job.user_id).ready_in(ahead + 1)
+
+    def order(self) -> List[FractalJob]:
+        """All the jobs in the order they would start, without cooldowns."""
+
+        guilds = deque(
+            deque(deque(jobs) for jobs in users.values())
+            for users in self.guilds.values()
+        )
+        order = []
+        while guilds:
+            users = guilds.popleft()
+            jobs = users.popleft()
+            order.append(jobs.popleft())
+            if jobs:
+                users.append(jobs)
+            if users:
+                guilds.append(users)
+        return order
+
+    def _pop_ready(self):
+        """Return the next job that can start, or how long to wait for one."""
+
+        wait = None
+        for guild_id, users in self.guilds.items():
+            for user_id, jobs in users.items():
+                ready_in = self.bucket(user_id).ready_in()
+                if ready_in > 0:
+                    wait = ready_in if wait is None else min(wait, ready_in)
+                    continue
+
+                self.bucket(user_id).take()
+                job = jobs.popleft()
+                # Round robin: this guild and user go to the end of the line
+                del users[user_id]
+                if jobs:
+                    users[user_id] = jobs
+                del self.guilds[guild_id]
+                if users:
+                    self.guilds[guild_id] = users
+                return job, None
+        return None, wait
+
+    async def get(self) -> FractalJob:
+        """Wait for the next job that can start, and remove it from the queue."""
+
+        while True:
+            job, wait = self._pop_ready()
+            if job is not None:
+                return job
+
+            self.changed.clear()
+            try:
+                await asyncio.wait_for(self.changed.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
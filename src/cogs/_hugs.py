@@ -0,0 +1,787 @@
+"""
+Storage and statistics for the hugs of MiscCog.
+
+This file is prefixed with a _ to avoid loading it as an extension.
+"""
+
+import calendar
+import json
+import math
+import mmap
+import os
+import re
+import struct
+from array import array
+from bisect import bisect_left, insort
+from collections import Counter, defaultdict
+from datetime import datetime
+from functools import lru_cache, partial
+from itertools import chain
+from pathlib import Path
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+
+HUG_RE = re.compile(r"^(?P<hugger>\d+) -> (?P<hugged>\d+) \| (?P<text>.*)$")
+
+RECORD = struct.Struct("<QQQQ")
+"""A hug in the binary log: hugger, hugged, timestamp, text id."""
+FIELDS = RECORD.size // 8
+HEADER = b"HUGLOG1\n".ljust(RECORD.size, b"\0")
+DAY = 24 * 60 * 60
+HUGGER_MARK = "\x01"
+HUGGED_MARK = "\x02"
+MENTION_RE = re.compile(r"(<@[!&]?)([0-9]+)>")
+
+
+class Hug:
+    __slots__ = ("hugger", "hugged", "text", "time")
+
+    def __init__(self, hugger, hugged, text, time=0):
+        self.hugger = hugger
+        self.hugged = hugged
+        self.text = text
+        self.time = time
+        """Unix timestamp of the hug, 0 for hugs older than the binary log."""
+
+    @classmethod
+    def from_str(cls, line: str):
+        match = HUG_RE.match(line)
+        if not match:
+            raise ValueError(f"'{line}' is not a valid hug format.")
+        hugger = int(match.group("hugger"))
+        hugged = int(match.group("hugged"))
+        text = match.group("text")
+
+        return cls(hugger, hugged, text)
+
+    def __repr__(self):
+        return f"{self.hugger} -> {self.hugged} | {self.text}"
+
+    def template(self) -> str:
+        """The text with the ids of the hugger and hugged replaced by marks."""
+        marks = {str(self.hugger): HUGGER_MARK, str(self.hugged): HUGGED_MARK}
+        return MENTION_RE.sub(
+            lambda m: m.group(1) + marks.get(m.group(2), m.group(2)) + ">", self.text
+        )
+
+    @staticmethod
+    def render(template: str, hugger: int, hugged: int) -> str:
+        return template.replace(HUGGER_MARK, str(hugger)).replace(
+            HUGGED_MARK, str(hugged)
+        )
+
+
+class HugStore:
+    """
+    The log of all hugs, indexed by hugger and by hugged.
+
+    The log is a binary file of fixed-width records (see RECORD) that
+    is memory-mapped, so hugs are read from the file only when needed.
+    Texts are mostly the same few sentences with different mentions, so
+    they are stored once as templates in a second file, one JSON
+    string per line, and records refer to them by index.
+    The indices keep row numbers in arrays, not python objects.
+
+    A hug can target a member or a role, like @everyone.
+    Queries about a member take the ids of their roles, so that
+    role hugs are found through the index of each role, and their cost
+    only depends on the number of hugs involving the member or their roles.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.texts_path = path.with_suffix(".texts")
+
+        if not path.exists() or path.stat().st_size < len(HEADER):
+            path.write_bytes(HEADER)
+        self.texts_path.touch()
+
+        self.texts: List[str] = [
+            json.loads(line) for line in self.texts_path.read_text().splitlines()
+        ]
+        self.text_ids = {text: i for i, text in enumerate(self.texts)}
+
+        # Drop a record half-written during a crash, it would shift the next ones
+        size = path.stat().st_size
+        extra = (size - len(HEADER)) % RECORD.size
+        if extra:
+            os.truncate(path, size - extra)
+
+        self._mmap = None
+        self._rows = None
+        self._map()
+
+        self.by_hugger: Dict[int, array] = defaultdict(partial(array, "I"))
+        self.by_hugged: Dict[int, array] = defaultdict(partial(array, "I"))
+        huggers = self._rows[0::FIELDS]
+        hugged = self._rows[1::FIELDS]
+        for row, (a, b) in enumerate(zip(huggers, hugged)):
+            self.by_hugger[a].append(row)
+            self.by_hugged[b].append(row)
+        huggers.release()
+        hugged.release()
+
+    def _map(self):
+        """(Re)map the log file after it grew."""
+
+        if self._mmap is not None:
+            self._rows.release()
+            self._mmap.close()
+
+        with open(self.path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._rows = memoryview(self._mmap)[len(HEADER) :].cast("Q")
+
+    def __len__(self):
+        return len(self._rows) // FIELDS
+
+    def __getitem__(self, row: int) -> Hug:
+        hugger, hugged, timestamp, text = self._rows[
+            row * FIELDS : (row + 1) * FIELDS
+        ].tolist()
+        text = Hug.render(self.texts[text], hugger, hugged)
+        return Hug(hugger, hugged, text, timestamp)
+
+    def __iter__(self) -> Iterator[Hug]:
+        for row in range(len(self)):
+            yield self[row]
+
+    def records(self, start=0) -> Iterator[Tuple[int, int, int]]:
+        """Iterate over (hugger, hugged, timestamp) without reading the texts."""
+        columns = [self._rows[start * FIELDS + i :: FIELDS] for i in range(3)]
+        try:
+            yield from zip(*columns)
+        finally:
+            for column in columns:
+                column.release()
+
+    def columns(self) -> "np.ndarray":
+        """A copy of the (hugger, hugged, timestamp) of all hugs, one row per hug."""
+        rows = np.frombuffer(self._rows, dtype=np.uint64).reshape(-1, FIELDS)
+        return rows[:, :3].copy()
+
+    def add(self, hug: Hug):
+        """Append a hug to the log."""
+        self.extend([hug])
+
+    def extend(self, hugs: Iterable[Hug]):
+        """Append hugs to the log, writing them at once."""
+
+        rows = len(self)
+        records = []
+        new_texts = []
+        for hug in hugs:
+            template = hug.template()
+            text = self.text_ids.get(template)
+            if text is None:
+                text = self.text_ids[template] = len(self.texts)
+                self.texts.append(template)
+                new_texts.append(json.dumps(template) + "\n")
+
+            records.append(RECORD.pack(hug.hugger, hug.hugged, int(hug.time), text))
+            self.by_hugger[hug.hugger].append(rows + len(records) - 1)
+            self.by_hugged[hug.hugged].append(rows + len(records) - 1)
+
+        # Texts go first, so that no record points to a missing text
+        with open(self.texts_path, "a") as f:
+            f.writelines(new_texts)
+        with open(self.path, "ab") as f:
+            f.writelines(records)
+        self._map()
+
+    def close(self):
+        self._rows.release()
+        self._mmap.close()
+
+    @staticmethod
+    def is_empty(path: Path) -> bool:
+        """Whether the binary log at path is missing or has no hug."""
+        return not path.exists() or path.stat().st_size < len(HEADER) + RECORD.size
+
+    @classmethod
+    def convert(cls, text_log: Path, path: Path) -> "HugStore":
+        """
+        Create a binary log at path from a text log of Hug.__repr__ lines.
+
+        The log is written to temporary files that replace the ones at path
+        only once it is complete, so a malformed line or a crash never leaves
+        a partial log behind, and the conversion is tried again next time.
+        """
+
+        tmp = path.with_name(path.stem + ".tmp" + path.suffix)
+        tmp_files = (tmp, tmp.with_suffix(".texts"))
+        for file in tmp_files:  # Left by a crash during a previous conversion
+            if file.exists():
+                file.unlink()
+
+        def parse(f):
+            for number, line in enumerate(f, 1):
+                if line.strip():
+                    try:
+                        yield Hug.from_str(line.rstrip("\n"))
+                    except ValueError as e:
+                        raise ValueError(f"{text_log}, line {number}: {e}") from e
+
+        store = cls(tmp)
+        try:
+            with open(text_log) as f:
+                store.extend(parse(f))
+        except BaseException:
+            store.close()
+            for file in tmp_files:
+                file.unlink()
+            raise
+        store.close()
+
+        # Texts first, so that the records never point to missing texts
+        os.replace(store.texts_path, path.with_suffix(".texts"))
+        os.replace(tmp, path)
+        return cls(path)
+
+    # Queries about one member. `roles` are the ids of the roles of the member.
+
+    def _hugger(self, row):
+        return self._rows[row * FIELDS]
+
+    def _hugged(self, row):
+        return self._rows[row * FIELDS + 1]
+
+    def given(self, who: int, roles: Set[int]) -> List[Hug]:
+        """Hugs given by who to someone else."""
+        return [
+            self[row]
+            for row in self.by_hugger.get(who, ())
+            if self._hugged(row) != who and self._hugged(row) not in roles
+        ]
+
+    def received(self, who: int, roles: Set[int]) -> List[Hug]:
+        """Hugs received by who, directly or through a role, from someone else."""
+        rows = chain.from_iterable(self.by_hugged.get(t, ()) for t in roles | {who})
+        return [self[row] for row in sorted(rows) if self._hugger(row) != who]
+
+    def self_hugs(self, who: int, roles: Set[int]) -> List[Hug]:
+        """Hugs given by who to themselves or one of their roles."""
+        return [
+            self[row]
+            for row in self.by_hugger.get(who, ())
+            if self._hugged(row) == who or self._hugged(row) in roles
+        ]
+
+    def last_received(self, who: int) -> Optional[Hug]:
+        """The last hug that targeted who directly."""
+        rows = self.by_hugged.get(who)
+        return self[rows[-1]] if rows else None
+
+
+class HyperLogLog:
+    """
+    Approximate number of distinct ids, in a fixed 2**P bytes.
+
+    Two sketches can be merged to count the ids of the union.
+    See Flajolet et al., "HyperLogLog: the analysis of a near-optimal
+    cardinality estimation algorithm", 2007.
+    """
+
+    P = 8
+    M = 1 << P
+    ALPHA = 0.7213 / (1 + 1.079 / M)
+    ERROR = 1.04 / M ** 0.5
+    """Typical relative error of the estimation."""
+
+    __slots__ = ("registers",)
+
+    def __init__(self, registers: bytes = None):
+        self.registers = bytearray(registers or self.M)
+
+    @staticmethod
+    @lru_cache(maxsize=1 << 16)
+    def _position(x: int) -> Tuple[int, int]:
+        """Return the register of an id and the rank it gives."""
+
+        # splitmix64, ids are too regular to be used directly
+        x = (x + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+        x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+        x ^= x >> 31
+
+        bits = 64 - HyperLogLog.P
+        return x >> bits, bits - (x & ((1 << bits) - 1)).bit_length() + 1
+
+    def add(self, x: int) -> bool:
+        """Add an id, return whether the sketch changed."""
+
+        register, rank = self._position(x)
+        if rank > self.registers[register]:
+            self.registers[register] = rank
+            return True
+        return False
+
+    def merge(self, other: "HyperLogLog") -> "HyperLogLog":
+        return HyperLogLog(bytes(map(max, self.registers, other.registers)))
+
+    def __len__(self):
+        estimate = self.ALPHA * self.M ** 2 / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.M and zeros:
+            # Small range correction, exact enough for the few huggers of most
+            estimate = self.M * math.log(self.M / zeros)
+        return round(estimate)
+
+
+class HugLeaderboard:
+    """
+    Running aggregates of the hugs received in one guild, kept sorted by score.
+
+    The score of a member is the number of hugs they received plus 42 times
+    the number of distinct members that hugged them. Hugs to @everyone count
+    for everyone that received at least one other hug, and hugs to a role
+    count for the members that have the role when the hug is added.
+
+    Hugs to @everyone shift every score by the same amount, so the
+    ranking is kept only on the part of the score that is specific
+    to each member, and reading the top K is O(K).
+
+    In approximate mode, the huggers of each member are not kept, but
+    counted with a HyperLogLog that uses a fixed amount of memory.
+    When the sketch of @everyone changes, which becomes rare quickly,
+    the ranking is rebuilt on the next read.
+    """
+
+    DISTINCT_BONUS = 42
+
+    def __init__(
+        self,
+        everyone: int,
+        members_of: Callable[[int], Optional[List[int]]],
+        approximate=False,
+    ):
+        """
+        :everyone: id of the @everyone role of the guild.
+        :members_of: return the ids of the members of a role, or None for members.
+        :approximate: whether to estimate the number of distinct huggers.
+        """
+        self.everyone = everyone
+        self.members_of = members_of
+        self.approximate = approximate
+
+        self.everyone_hugs = 0
+        self.received = Counter()
+
+        if approximate:
+            self.everyone_sketch = HyperLogLog()
+            self.sketches: Dict[int, HyperLogLog] = defaultdict(HyperLogLog)
+            """self.sketches[hugged] = sketch of their huggers"""
+        else:
+            self.everyone_huggers: Set[int] = set()
+            self.huggers: Dict[int, Set[int]] = defaultdict(set)
+            """self.huggers[hugged] = {huggers}"""
+            self.hugged_by: Dict[int, Set[int]] = defaultdict(set)
+            """self.hugged_by[hugger] = {hugged}, the reverse of self.huggers"""
+            self.outside = Counter()
+            """self.outside[hugged] = their huggers that never hugged @everyone"""
+
+        self.ranking: List[Tuple[int, int]] = []
+        """Sorted list of (-own score, id)"""
+        self.own_score = {}
+        self._stale = False
+        """Whether the ranking needs to be rebuilt."""
+
+    def __len__(self):
+        return len(self.received)
+
+    def extend(self, hugs: Iterable[Hug]):
+        # Roles are resolved once and the ranking sorted once for the whole batch
+        members_of = self.members_of
+        self.members_of = lru_cache(maxsize=None)(members_of)
+        self._stale = True
+        try:
+            for hug in hugs:
+                self.add(hug)
+        finally:
+            self.members_of = members_of
+
+    def add(self, hug: Hug):
+        hugger = hug.hugger
+
+        if hug.hugged == self.everyone:
+            self.everyone_hugs += 1
+            if self.approximate:
+                if self.everyone_sketch.add(hugger):
+                    self._stale = True
+            elif hugger not in self.everyone_huggers:
+                self.everyone_huggers.add(hugger)
+                # Already counted in the union for those
+                for hugged in self.hugged_by[hugger]:
+                    self.outside[hugged] -= 1
+                    self._update(hugged)
+            return
+
+        targets = [hug.hugged] if hug.hugged != hugger else []
+        targets += [m for m in self.members_of(hug.hugged) or () if m != hugger]
+
+        for hugged in targets:
+            self.received[hugged] += 1
+            if self.approximate:
+                self.sketches[hugged].add(hugger)
+            else:
+                huggers = self.huggers[hugged]
+                if hugger not in huggers:
+                    huggers.add(hugger)
+                    self.hugged_by[hugger].add(hugged)
+                    if hugger not in self.everyone_huggers:
+                        self.outside[hugged] += 1
+            self._update(hugged)
+
+    def _own_score(self, hugged: int) -> int:
+        """The part of the score that is not shared by everyone."""
+
+        if self.approximate:
+            distinct = len(self.sketches[hugged].merge(self.everyone_sketch))
+        else:
+            distinct = self.outside[hugged]
+        return self.received[hugged] + self.DISTINCT_BONUS * distinct
+
+    def _update(self, hugged: int):
+        if self._stale:
+            return  # Everything is recomputed on the next read
+
+        new = self._own_score(hugged)
+        old = self.own_score.get(hugged)
+        self.own_score[hugged] = new
+
+        if old is not None:
+            del self.ranking[bisect_left(self.ranking, (-old, hugged))]
+        insort(self.ranking, (-new, hugged))
+
+    def _rebuild(self):
+        self.own_score = {hugged: self._own_score(hugged) for hugged in self.received}
+        self.ranking = sorted((-s, hugged) for hugged, s in self.own_score.items())
+        self._stale = False
+
+    def common_score(self):
+        """The part of the score given by hugs to @everyone."""
+        if self.approximate:
+            return self.everyone_hugs
+        return self.DISTINCT_BONUS * len(self.everyone_huggers) + self.everyone_hugs
+
+    def score(self, hugged: int) -> int:
+        if self._stale:
+            self._rebuild()
+        if hugged not in self.own_score:
+            return 0
+        return self.own_score[hugged] + self.common_score()
+
+    def top(self, k: int) -> List[Tuple[int, int]]:
+        """Return the k pairs (id, score) with the highest score."""
+        if self._stale:
+            self._rebuild()
+        common = self.common_score()
+        return [(hugged, common - s) for s, hugged in self.ranking[:k]]
+
+
+def month_start(timestamp: int) -> int:
+    date = datetime.utcfromtimestamp(timestamp)
+    return calendar.timegm((date.year, date.month, 1, 0, 0, 0))
+
+
+def next_month(month: int) -> int:
+    return month_start(month + 32 * DAY)
+
+
+class HugTimeline:
+    """
+    Number of hugs given and received per member, in time buckets.
+
+    Hugs of the last DAYS_KEPT days are counted per day, and older ones are
+    rolled up into one bucket per month, so memory grows with the number of
+    months and not the number of hugs. Hugs to oneself are not counted and
+    hugs to a role are counted for the role.
+    """
+
+    DAYS_KEPT = 62
+
+    def __init__(self):
+        self.days: Dict[int, Tuple[Counter, Counter]] = {}
+        """self.days[day start] = (given, received)"""
+        self.months: Dict[int, Tuple[Counter, Counter]] = {}
+        """self.months[month start] = (given, received)"""
+        self.today = 0
+
+    def extend(self, records: Iterable[Tuple[int, int, int]]):
+        for hugger, hugged, timestamp in records:
+            self.add(hugger, hugged, timestamp)
+
+    def add(self, hugger: int, hugged: int, timestamp: int):
+        if not timestamp or hugger == hugged:
+            return  # Hugs older than timestamps are only in the all-time stats
+
+        day = timestamp - timestamp % DAY
+        if day > self.today:
+            self.today = day
+            self._roll_up()
+
+        if day < self.horizon():
+            given, received = self.months.setdefault(
+                month_start(day), (Counter(), Counter())
+            )
+        else:
+            given, received = self.days.setdefault(day, (Counter(), Counter()))
+        given[hugger] += 1
+        received[hugged] += 1
+
+    def horizon(self):
+        """Start of the oldest day that has its own bucket."""
+        return self.today - self.DAYS_KEPT * DAY
+
+    def _roll_up(self):
+        horizon = self.horizon()
+        for day in [d for d in self.days if d < horizon]:
+            given, received = self.days.pop(day)
+            month = self.months.setdefault(month_start(day), (Counter(), Counter()))
+            month[0].update(given)
+            month[1].update(received)
+
+    def _buckets(self, since: int, until: int = None):
+        """
+        The buckets that overlap [since, until).
+
+        A month bucket is taken whole, so a window that starts before
+        the horizon has the precision of one month.
+        """
+        for start, bucket in self.days.items():
+            if start + DAY > since and (until is None or start < until):
+                yield bucket
+        for start, bucket in self.months.items():
+            if next_month(start) > since and (until is None or start < until):
+                yield bucket
+
+    def given(self, since: int, until: int = None) -> Counter:
+        """Number of hugs given by each member in the window."""
+        total = Counter()
+        for given, _ in self._buckets(since, until):
+            total.update(given)
+        return total
+
+    def received(self, since: int, until: int = None) -> Counter:
+        """Number of hugs received by each member or role in the window."""
+        total = Counter()
+        for _, received in self._buckets(since, until):
+            total.update(received)
+        return total
+
+
+class HugGraph:
+    """
+    The directed graph of who hugs whom, for one guild.
+
+    The graph is kept as a sparse adjacency matrix. New hugs are appended
+    to coordinate arrays in O(1), and only this delta is merged into the
+    matrix when the analytics are recomputed, which happens at most once
+    per new hug and can run in another process: compute() only works on
+    a snapshot().
+
+    Hugs to roles and to oneself are not part of the graph.
+    """
+
+    DAMPING = 0.85
+    COMMUNITY_THRESHOLD = 2
+    """Minimum number of hugs in both directions for two members to be close."""
+
+    def __init__(self, is_member: Callable[[int], bool]):
+        self.is_member = is_member
+        self.index: Dict[int, int] = {}
+        self.ids = array("Q")
+        self.adjacency = sparse.csr_matrix((0, 0))
+        """[i, j] is the number of hugs from i to j, without the new hugs."""
+        self.huggers = array("I")
+        self.hugged = array("I")
+        """The new hugs, not yet merged into the adjacency matrix."""
+        self.version = 0
+        """Incremented with each hug, to know whether the analytics are outdated."""
+
+    def _node(self, id_: int) -> int:
+        node = self.index.get(id_)
+        if node is None:
+            node = self.index[id_] = len(self.ids)
+            self.ids.append(id_)
+        return node
+
+    def extend(self, records: Iterable[Tuple[int, int, int]]):
+        for hugger, hugged, _ in records:
+            self.add(hugger, hugged)
+
+    def add(self, hugger: int, hugged: int):
+        if hugger == hugged or not self.is_member(hugged):
+            return
+
+        self.huggers.append(self._node(hugger))
+        self.hugged.append(self._node(hugged))
+        self.version += 1
+
+    def _merge(self):
+        """Add the new hugs to the adjacency matrix."""
+
+        n = len(self.ids)
+        old = self.adjacency
+        # New members get empty rows and columns. The matrix is never
+        # modified in place, as a snapshot may still use it.
+        grown = sparse.csr_matrix(
+            (
+                old.data,
+                old.indices,
+                np.pad(old.indptr, (0, n - old.shape[0]), mode="edge"),
+            ),
+            shape=(n, n),
+        )
+        delta = sparse.coo_matrix(
+            (
+                np.ones(len(self.huggers)),
+                (
+                    np.frombuffer(self.huggers, dtype=np.uint32),
+                    np.frombuffer(self.hugged, dtype=np.uint32),
+                ),
+            ),
+            shape=(n, n),
+        )
+        self.adjacency = grown + delta.tocsr()
+        self.huggers = array("I")
+        self.hugged = array("I")
+
+    def snapshot(self) -> "HugGraphSnapshot":
+        """What compute() needs, which does not change when hugs are added."""
+
+        if self.huggers:
+            self._merge()
+        return HugGraphSnapshot(
+            self.version, np.array(self.ids, dtype=np.uint64), self.adjacency
+        )
+
+
+class HugGraphSnapshot(NamedTuple):
+    version: int
+    ids: "np.ndarray"
+    adjacency: "sparse.csr_matrix"
+    """Sparse matrix where [i, j] is the number of hugs from i to j."""
+
+    def compute(self) -> "HugGraphStats":
+        """Compute all the analytics. This is CPU-bound and runs in a worker."""
+
+        adjacency = self.adjacency
+        return HugGraphStats(
+            self.version,
+            self.warmth(adjacency),
+            self.mutual_pairs(adjacency),
+            self.communities(adjacency),
+        )
+
+    def warmth(self, adjacency, iterations=100, tol=1e-10) -> Dict[int, float]:
+        """
+        PageRank where each hug is a vote: hugs from warm members count more.
+
+        Scores are scaled so that the average member has a warmth of 1.
+        """
+
+        n = adjacency.shape[0]
+        if n == 0:
+            return {}
+
+        out = np.asarray(adjacency.sum(axis=1)).ravel()
+        dangling = out == 0
+        # Transition matrix, normalized by the number of hugs given
+        inv_out = np.divide(1, out, out=np.zeros(n), where=~dangling)
+        transition = sparse.diags(inv_out) @ adjacency
+
+        damping = HugGraph.DAMPING
+        rank = np.full(n, 1 / n)
+        for _ in range(iterations):
+            # Members that never hugged give their warmth to everyone
+            new = damping * (transition.T @ rank + rank[dangling].sum() / n)
+            new += (1 - damping) / n
+            converged = np.abs(new - rank).sum() < tol
+            rank = new
+            if converged:
+                break
+
+        return dict(zip(self.ids.tolist(), (rank * n).tolist()))
+
+    def mutual_pairs(self, adjacency) -> List[Tuple[int, int, int]]:
+        """
+        Pairs of members that hugged each other, as (id, id, hugs), sorted
+        by the number of hugs in the direction where there were the fewest.
+        """
+
+        mutual = sparse.triu(adjacency.minimum(adjacency.T), k=1).tocoo()
+        order = np.argsort(-mutual.data, kind="stable")
+        ids = self.ids
+        return [
+            (int(ids[mutual.row[i]]), int(ids[mutual.col[i]]), int(mutual.data[i]))
+            for i in order
+        ]
+
+    def communities(self, adjacency) -> List[List[int]]:
+        """
+        Groups of members linked by close members, largest first.
+
+        Two members are close when they hugged each other at least
+        COMMUNITY_THRESHOLD times each, and members alone are left out.
+        """
+
+        mutual = adjacency.minimum(adjacency.T)
+        close = mutual >= HugGraph.COMMUNITY_THRESHOLD
+        _, labels = csgraph.connected_components(close, directed=False)
+
+        groups = defaultdict(list)
+        for node, label in enumerate(labels.tolist()):
+            groups[label].append(int(self.ids[node]))
+        return sorted((g for g in groups.values() if len(g) > 1), key=len, reverse=True)
+
+
+class HugGraphStats(NamedTuple):
+    version: int
+    warmth: Dict[int, float]
+    mutual_pairs: List[Tuple[int, int, int]]
+    communities: List[List[int]]
+
+
+# The statistics are built from the whole log by the cog, in a worker process,
+# from a copy of HugStore.columns(), since the log itself cannot be sent there.
+# Functions of the guild cannot be sent either: the cog sets them again.
+
+
+def build_leaderboard(
+    records: "np.ndarray", everyone: int, roles: Dict[int, List[int]], approximate
+) -> HugLeaderboard:
+    """:roles: the ids of the members of each role that was hugged."""
+
+    board = HugLeaderboard(everyone, roles.get, approximate)
+    board.extend(Hug(hugger, hugged, "") for hugger, hugged, _ in records.tolist())
+    board.top(0)  # Sorts the ranking here rather than on the first read
+    board.members_of = None
+    return board
+
+
+def build_timeline(records: "np.ndarray") -> HugTimeline:
+    timeline = HugTimeline()
+    timeline.extend(records.tolist())
+    return timeline
+
+
+def build_graph(records: "np.ndarray", roles: Set[int]) -> HugGraph:
+    graph = HugGraph(lambda id_: id_ not in roles)
+    graph.extend(records.tolist())
+    graph.snapshot()  # Merges the hugs into the adjacency matrix here
+    graph.is_member = None
+    return graph
@@ -0,0 +1,481 @@
+"""
+Storage of the jokes of MiscCog.
+
+This file is prefixed with a _ to avoid loading it as an extension.
+"""
+
+import hashlib
+import heapq
+import io
+import json
+import math
+import os
+import random
+import re
+import unicodedata
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from pathlib import Path
+from time import time
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import yaml
+from PIL import Image, ImageOps, UnidentifiedImageError
+from sortedcontainers import SortedList
+
+
+@dataclass
+class Joke(yaml.YAMLObject):
+    yaml_tag = "Joke"
+    yaml_dumper = yaml.SafeDumper
+    yaml_loader = yaml.SafeLoader
+    joke: str
+    joker: int
+    likes: Set[int] = field(default_factory=set)
+    dislikes: Set[int] = field(default_factory=set)
+    file: str = None
+
+    @property
+    def score(self):
+        return len(self.likes) - len(self.dislikes)
+
+
+class FenwickTree:
+    """
+    Weights with O(log n) updates, prefix sums and weighted sampling.
+
+    self.tree[i] is the sum of the weights in (i - lowbit(i), i], 1-indexed.
+    """
+
+    def __init__(self, weights: List[float] = ()):
+        self.weights = []
+        self.tree = [0.0]
+        for weight in weights:
+            self.append(weight)
+
+    def __len__(self):
+        return len(self.weights)
+
+    def prefix(self, n: int) -> float:
+        """Sum of the first n weights."""
+
+        total = 0.0
+        while n > 0:
+            total += self.tree[n]
+            n &= n - 1
+        return total
+
+    @property
+    def total(self) -> float:
+        return self.prefix(len(self.weights))
+
+    def append(self, weight: float):
+        self.weights.append(weight)
+        i = len(self.weights)
+        self.tree.append(weight + self.prefix(i - 1) - self.prefix(i & (i - 1)))
+
+    def set(self, index: int, weight: float):
+        delta = weight - self.weights[index]
+        self.weights[index] = weight
+        i = index + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def find(self, x: float) -> int:
+        """Return the first index whose prefix sum, itself included, exceeds x."""
+
+        pos = 0
+        step = 1 << (len(self.tree) - 1).bit_length()
+        while step:
+            if pos + step < len(self.tree) and self.tree[pos + step] <= x:
+                pos += step
+                x -= self.tree[pos]
+            step >>= 1
+        return min(pos, len(self.weights) - 1)
+
+    def sample(self) -> int:
+        """Return an index with a probability proportional to its weight."""
+        return self.find(random.random() * self.total)
+
+
+WORD_RE = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Split a text in lowercase words without accents."""
+
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return WORD_RE.findall(text)
+
+
+class JokeIndex:
+    """
+    Inverted index of the jokes, ranking matches with BM25.
+
+    Only the jokes containing a word of the query are scored, so a search
+    takes time proportional to the number of matches, not of jokes.
+    """
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, jokes: List[Joke] = ()):
+        self.postings: Dict[str, Dict[int, int]] = defaultdict(dict)
+        """self.postings[word][joke_id] = number of occurrences of word in the joke"""
+        self.lengths: List[int] = []
+        self.total_length = 0
+        for joke in jokes:
+            self.add(joke)
+
+    def add(self, joke: Joke):
+        """Index a joke, whose id is the number of jokes already indexed."""
+
+        joke_id = len(self.lengths)
+        words = tokenize(joke.joke)
+        for word, count in Counter(words).items():
+            self.postings[word][joke_id] = count
+        self.lengths.append(len(words))
+        self.total_length += len(words)
+
+    def search(self, query: str, k: int) -> List[Tuple[float, int]]:
+        """Return the (score, joke_id) of the k jokes that best match the query."""
+
+        n = len(self.lengths)
+        if not n:
+            return []
+        average_length = self.total_length / n or 1
+
+        scores = Counter()
+        for word in set(tokenize(query)):
+            postings = self.postings.get(word)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for joke_id, count in postings.items():
+                norm = 1 - self.B + self.B * self.lengths[joke_id] / average_length
+                tf = count * (self.K1 + 1) / (count + self.K1 * norm)
+                scores[joke_id] += idf * tf
+
+        return heapq.nlargest(k, ((score, i) for i, score in scores.items()))
+
+
+class JokeStore:
+    """
+    All the jokes, kept in memory.
+
+    Jokes are saved in a YAML file with one document per joke. Votes are
+    appended to a journal, one line per vote, and the journal is compacted
+    into the YAML file every COMPACT_AFTER votes. A vote sets whether a
+    user likes or dislikes a joke, so replaying the journal more than once,
+    after a crash during a compaction, gives the same result.
+
+    The ranking keeps the jokes ordered by score, the oldest first among
+    jokes with the same score, and is updated on each vote. So are the
+    weights used to pick jokes that people like more often.
+    """
+
+    COMPACT_AFTER = 200
+    LIKE = "+"
+    DISLIKE = "-"
+    REMOVE = "~"
+    """Prefix of the kind of vote when the vote is removed."""
+
+    def __init__(self, path: Path, journal: Path):
+        self.path = path
+        self.journal = journal
+
+        path.touch()
+        with open(path) as f:
+            self.jokes: List[Joke] = list(yaml.safe_load_all(f))
+
+        journal.touch()
+        self.journal_size = self._replay()
+
+        self.ranking = SortedList(self._rank_key(i) for i in range(len(self.jokes)))
+        self.weights = FenwickTree([self._weight(joke) for joke in self.jokes])
+        self.index = JokeIndex(self.jokes)
+
+    def __len__(self):
+        return len(self.jokes)
+
+    def __getitem__(self, joke_id: int) -> Joke:
+        return self.jokes[joke_id]
+
+    def __iter__(self) -> Iterator[Joke]:
+        return iter(self.jokes)
+
+    def add(self, joke: Joke) -> int:
+        """Add a joke and return its id."""
+
+        self.jokes.append(joke)
+        joke_id = len(self.jokes) - 1
+        self.ranking.add(self._rank_key(joke_id))
+        self.weights.append(self._weight(joke))
+        self.index.add(joke)
+        with open(self.path, "a") as f:
+            yaml.safe_dump_all([joke], f, explicit_start=True)
+        return joke_id
+
+    def _rank_key(self, joke_id: int):
+        return -self.jokes[joke_id].score, joke_id
+
+    @staticmethod
+    def _weight(joke: Joke) -> float:
+        return (1 + len(joke.likes)) / (1 + len(joke.dislikes))
+
+    def random(self, weighted=False) -> int:
+        """
+        Return the id of a random joke.
+
+        If weighted, each joke is picked with a probability proportional to
+        (1 + likes) / (1 + dislikes), otherwise all jokes are equally likely.
+        """
+
+        if not self.jokes:
+            raise IndexError("No jokes")
+        if weighted:
+            return self.weights.sample()
+        return random.randrange(len(self.jokes))
+
+    def ranked(self, rank: int) -> int:
+        """Return the id of the joke at the given rank, the best being 0."""
+
+        if not 0 <= rank < len(self.ranking):
+            raise IndexError(rank)
+        return self.ranking[rank][1]
+
+    def rank(self, joke_id: int) -> int:
+        """Return the rank of a joke, the best being 0."""
+        return self.ranking.index(self._rank_key(joke_id))
+
+    def search(self, query: str, k: int) -> List[Tuple[float, int]]:
+        """Return the (relevance, joke_id) of the k jokes best matching the query."""
+        return self.index.search(query, k)
+
+    def top(self, k: int) -> List[int]:
+        """Return the ids of the k best jokes."""
+        return [joke_id for _, joke_id in self.ranking.islice(0, k)]
+
+    def vote(self, joke_id: int, user_id: int, like: bool, remove=False):
+        kind = self.REMOVE * remove + (self.LIKE if like else self.DISLIKE)
+        self.ranking.remove(self._rank_key(joke_id))
+        self._apply(kind, joke_id, user_id)
+        self.ranking.add(self._rank_key(joke_id))
+        self.weights.set(joke_id, self._weight(self.jokes[joke_id]))
+
+        with open(self.journal, "a") as f:
+            f.write(f"{kind} {joke_id} {user_id}\n")
+        self.journal_size += 1
+
+        if self.journal_size >= self.COMPACT_AFTER:
+            self.compact()
+
+    def _apply(self, kind: str, joke_id: int, user_id: int):
+        joke = self.jokes[joke_id]
+        votes = joke.likes if kind.endswith(self.LIKE) else joke.dislikes
+        if kind.startswith(self.REMOVE):
+            votes.discard(user_id)
+        else:
+            votes.add(user_id)
+
+    def _replay(self) -> int:
+        """
+        Apply the votes of the journal and return their number.
+
+        A crash while a vote is appended can leave an incomplete last line,
+        which is dropped from the journal, so that the next votes are not
+        appended to it.
+        """
+
+        with open(self.journal, "rb") as f:
+            data = f.read()
+        end = data.rfind(b"\n") + 1  # What follows the last newline is incomplete
+        lines = data[:end].decode().splitlines()
+
+        votes = []
+        for i, line in enumerate(lines):
+            try:
+                kind, joke_id, user_id = line.split()
+                votes.append((kind, int(joke_id), int(user_id)))
+            except ValueError:
+                if i < len(lines) - 1:
+                    raise ValueError(f"{self.journal}, line {i + 1}: '{line}'")
+                end -= len(line.encode()) + 1
+
+        if end < len(data):
+            os.truncate(self.journal, end)
+
+        for vote in votes:
+            self._apply(*vote)
+        return len(votes)
+
+    def compact(self):
+        """Save all jokes in the YAML file and empty the journal."""
+
+        tmp = self.path.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            yaml.safe_dump_all(self.jokes, f)
+        os.replace(tmp, self.path)
+
+        self.journal.write_text("")
+        self.journal_size = 0
+
+
+class JokeMessages:
+    """
+    The messages showing a joke, where reactions are votes until they expire.
+
+    They are saved in a JSON file, so votes keep working after a restart.
+    """
+
+    VOTE_DURATION = 5 * 24 * 60 * 60
+
+    def __init__(self, path: Path):
+        self.path = path
+        path.touch()
+        now = time()
+        self.messages: Dict[int, Tuple[int, float]] = {
+            int(message_id): (joke_id, expires)
+            for message_id, (joke_id, expires) in json.loads(
+                path.read_text() or "{}"
+            ).items()
+            if expires > now
+        }
+        """self.messages[message_id] = (joke_id, expiration timestamp)"""
+
+    def save(self):
+        self.path.write_text(json.dumps(self.messages))
+
+    def add(self, message_id: int, joke_id: int):
+        now = time()
+        self.messages = {
+            m: (j, expires)
+            for m, (j, expires) in self.messages.items()
+            if expires > now
+        }
+        self.messages[message_id] = (joke_id, now + self.VOTE_DURATION)
+        self.save()
+
+    def get(self, message_id: int) -> Optional[int]:
+        """Return the id of the joke shown in the message, if votes are open."""
+
+        joke_id, expires = self.messages.get(message_id, (None, 0))
+        if expires < time():
+            return None
+        return joke_id
+
+
+class MemeStore:
+    """
+    The images and files of the jokes, named by the hash of their content.
+
+    A file sent twice is stored once. The URL of the first upload of each
+    file is remembered, so it can be shown again without uploading it.
+    """
+
+    IMAGE_SUFFIXES = {".png", ".jpg", ".jpeg", ".gif", ".webp"}
+
+    def __init__(self, directory: Path, urls: Path):
+        self.directory = directory
+        self.urls_path = urls
+        directory.mkdir(parents=True, exist_ok=True)
+        urls.touch()
+        self.urls: Dict[str, str] = json.loads(urls.read_text() or "{}")
+        """self.urls[name] = URL where the file was uploaded"""
+
+    def path(self, name: str) -> Path:
+        return self.directory / name
+
+    def thumbnail_path(self, name: str) -> Path:
+        return self.directory / (Path(name).stem + ".thumb.webp")
+
+    def save(self, data: bytes, filename: str, thumbnail: bytes = None) -> str:
+        """Store the content of a file, if new, and return its name in the store."""
+
+        suffix = Path(filename).suffix.lower()
+        name = hashlib.sha256(data).hexdigest() + suffix
+        path = self.path(name)
+        if not path.exists():
+            path.write_bytes(data)
+        if thumbnail:
+            self.thumbnail_path(name).write_bytes(thumbnail)
+        return name
+
+    def url(self, name: str) -> Optional[str]:
+        """Return the URL of an upload of the image, if it can be shown in an embed."""
+
+        if Path(name).suffix.lower() not in self.IMAGE_SUFFIXES:
+            return None
+        return self.urls.get(name)
+
+    def remember(self, name: str, url: str):
+        self.urls[name] = url
+        self.urls_path.write_text(json.dumps(self.urls))
+
+    def forget(self, name: str):
+        if self.urls.pop(name, None) is not None:
+            self.urls_path.write_text(json.dumps(self.urls))
+
+
+MAX_MEME_SIDE = 1920
+MIN_MEME_SIDE = 256
+"""Images are not downsized further to fit in the budget."""
+THUMBNAIL_SIDE = 128
+"""Side of the thumbnails shown in the lists of jokes."""
+QUALITIES = (85, 70, 55, 40)
+INGEST_TIMEOUT = 30
+"""Seconds to prepare the file of a new joke."""
+
+
+def ingest_meme(
+    data: bytes, filename: str, budget: int
+) -> Tuple[bytes, str, Optional[bytes]]:
+    """
+    Prepare the file of a new joke to be stored and shown.
+
+    Images are turned upright, downsized to MAX_MEME_SIDE, and re-encoded
+    as WebP without their metadata, lowering the quality then the size
+    until they fit in the budget, in bytes. A thumbnail is made too.
+    Other files, and animations, are kept as is.
+
+    This decodes whole images: it is meant to run in a worker process.
+
+    Returns:
+        The data of the file, its new filename and the thumbnail, if any.
+    """
+
+    try:
+        img = Image.open(io.BytesIO(data))
+        img.load()
+    except (UnidentifiedImageError, OSError):
+        return data, filename, None
+
+    if getattr(img, "is_animated", False):
+        return data, filename, None
+
+    img = ImageOps.exif_transpose(img)
+    img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+    img.thumbnail((MAX_MEME_SIDE, MAX_MEME_SIDE))
+
+    thumbnail = img.copy()
+    thumbnail.thumbnail((THUMBNAIL_SIDE, THUMBNAIL_SIDE))
+    thumbnail = _encode_webp(thumbnail, QUALITIES[-1])
+
+    while True:
+        for quality in QUALITIES:
+            encoded = _encode_webp(img, quality)
+            if len(encoded) <= budget:
+                break
+        if len(encoded) <= budget or min(img.size) <= MIN_MEME_SIDE:
+            break
+        img = img.resize((img.width * 3 // 4, img.height * 3 // 4), Image.LANCZOS)
+
+    return encoded, Path(filename).stem + ".webp", thumbnail
+
+
+def _encode_webp(img: Image.Image, quality: int) -> bytes:
+    out = io.BytesIO()
+    img.save(out, "WEBP", quality=quality, method=4)
+    return out.getvalue()
@@ -0,0 +1,160 @@
+"""
+Streaming statistics over CSV files, for the calc commands of MiscCog.
+
+This file is prefixed with a _ to avoid loading it as an extension.
+"""
+
+import csv
+import io
+import itertools
+import urllib.request
+from time import monotonic
+from typing import Dict, Iterable, Iterator, List
+
+import numpy as np
+
+CHUNK_ROWS = 10_000
+SAMPLE_SIZE = 10_000
+"""Number of values per column kept to estimate quantiles and histograms."""
+HISTOGRAM_BINS = 16
+BARS = " ▁▂▃▄▅▆▇█"
+DELIMITERS = ",;\t|"
+DOWNLOAD_TIMEOUT = 10
+"""Seconds without data after which a download fails."""
+STATS_TIMEOUT = 60
+"""Seconds to download a file and compute its statistics."""
+
+
+class ColumnStats:
+    """
+    Statistics of the numbers of a column, updated one chunk at a time.
+
+    Count, mean, standard deviation, min and max are exact. Quantiles and
+    the histogram are computed on a uniform sample of SAMPLE_SIZE values:
+    each value gets a random key and the values with the smallest keys
+    are kept.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        """Sum of the squared distances to the mean."""
+        self.min = np.inf
+        self.max = -np.inf
+        self.sample = np.empty(0)
+        self.keys = np.empty(0)
+
+    def update(self, values: np.ndarray):
+        values = values[np.isfinite(values)]
+        n = len(values)
+        if not n:
+            return
+
+        # Chan et al. formula to merge the mean and variance of two sets
+        mean = values.mean()
+        delta = mean - self.mean
+        total = self.count + n
+        self.m2 += ((values - mean) ** 2).sum() + delta ** 2 * self.count * n / total
+        self.mean += delta * n / total
+        self.count = total
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+
+        keys = np.concatenate((self.keys, np.random.random(n)))
+        sample = np.concatenate((self.sample, values))
+        if len(keys) > SAMPLE_SIZE:
+            kept = np.argpartition(keys, SAMPLE_SIZE)[:SAMPLE_SIZE]
+            keys, sample = keys[kept], sample[kept]
+        self.keys, self.sample = keys, sample
+
+    @property
+    def std(self):
+        return (self.m2 / self.count) ** 0.5 if self.count else 0.0
+
+    def quantiles(self, qs=(0.25, 0.5, 0.75)) -> List[float]:
+        return list(np.quantile(self.sample, qs))
+
+    def histogram(self) -> str:
+        counts, _ = np.histogram(self.sample, HISTOGRAM_BINS, (self.min, self.max))
+        scale = (len(BARS) - 1) / counts.max()
+        return "".join(BARS[int(np.ceil(c * scale))] for c in counts)
+
+    def __str__(self):
+        q1, median, q3 = self.quantiles()
+        return (
+            f"count {self.count}, mean {self.mean:.6g}, std {self.std:.6g}\n"
+            f"min {self.min:.6g}, q1 {q1:.6g}, median {median:.6g}, "
+            f"q3 {q3:.6g}, max {self.max:.6g}\n"
+            f"`{self.min:.3g} {self.histogram()} {self.max:.3g}`"
+        )
+
+
+def read_lines(url: str) -> Iterator[str]:
+    """
+    Download a text file line by line.
+
+    Raises TimeoutError after STATS_TIMEOUT, so that the thread stops soon
+    after the cog gave up on it.
+    """
+
+    deadline = monotonic() + STATS_TIMEOUT
+    with urllib.request.urlopen(url, timeout=DOWNLOAD_TIMEOUT) as response:
+        for line in io.TextIOWrapper(response, encoding="utf-8", errors="replace"):
+            if monotonic() > deadline:
+                raise TimeoutError(f"Download longer than {STATS_TIMEOUT}s.")
+            yield line
+
+
+def read_rows(lines: Iterator[str]) -> Iterator[List[str]]:
+    """Parse CSV lines, guessing the delimiter from the header."""
+
+    first = next(lines, "")
+    delimiter = max(DELIMITERS, key=first.count)
+    return csv.reader(itertools.chain([first], lines), delimiter=delimiter)
+
+
+def chunks(rows: Iterable[List[str]], size=CHUNK_ROWS) -> Iterator[List[List[str]]]:
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def to_float(cell: str) -> float:
+    try:
+        return float(cell)
+    except ValueError:
+        return np.nan
+
+
+def column_stats(rows: Iterator[List[str]]) -> List[ColumnStats]:
+    """
+    Statistics of the numeric columns, the first row being the header.
+
+    Rows are processed by chunks of CHUNK_ROWS, so only one chunk is in
+    memory at a time. Cells that are not numbers are ignored.
+    """
+
+    header = next(rows, [])
+    stats: Dict[int, ColumnStats] = {
+        i: ColumnStats(name.strip() or f"Column {i + 1}")
+        for i, name in enumerate(header)
+    }
+
+    for chunk in chunks(rows):
+        for i, column in stats.items():
+            values = np.array(
+                [to_float(row[i]) if i < len(row) else np.nan for row in chunk]
+            )
+            column.update(values)
+
+    return [column for column in stats.values() if column.count]
+
+
+def csv_stats(url: str) -> List[ColumnStats]:
+    """Download a CSV file and compute its statistics, in a streaming way."""
+    return column_stats(read_rows(read_lines(url)))
@@ -30,6 +30,7 @@ from engine import (
     french_join,
     mentions_to_id,
     myembed,
+    POOLS,
     start_time,
 )
 from src.cogs.perms import RuleSet
@@ -121,6 +122,9 @@ class InfoCog(CustomCog, name="Infos"):
             "Voice channels": vocal,
             "Number of roles": len(guild.roles),
             "Bot uptime": uptime,
+            "Worker jobs": ", ".join(
+                f"{name} {pool.running}+{pool.queued}" for name, pool in POOLS.items()
+            ),
         }
 
         width = max(map(len, infos))
@@ -1,23 +1,15 @@
-import ast
 import asyncio
 import io
-import math
-import operator as op
+import os
 import random
-import re
-import traceback
-import urllib
-from collections import Counter, defaultdict
-from dataclasses import dataclass, field
+from collections import Counter
+from datetime import datetime
 from functools import partial
-from math import factorial
-from operator import itemgetter
 from time import time
-from typing import List, Set, Union
+from typing import List, Optional, Tuple, Union
 
 import aiohttp
 import discord
-import yaml
 from discord import (
     AllowedMentions,
     Member,
@@ -25,7 +17,10 @@ from discord import (
 
 from discord.ext.commands import (
     BadArgument,
+    Cog,
     command,
+    CommandError,
+    CommandInvokeError,
     Context,
     group,
     MemberConverter,
@@ -38,79 +33,89 @@ from engine import (
     CozyError,
     CustomBot,
     CustomCog,
+    french_join,
+    parse_duration,
+    run_cpu_bound,
     with_max_len,
+    worker_pool,
 )
 
+from src.cogs._calc import CalcResult, CalcSandbox, normalize
+from src.cogs._fractal import FairQueue, FractalJob, QueueFull, render_fractal_tiled
+from src.cogs._hugs import (
+    build_graph,
+    build_leaderboard,
+    build_timeline,
+    DAY,
+    Hug,
+    HugGraph,
+    HugGraphStats,
+    HugLeaderboard,
+    HugStore,
+    HugTimeline,
+    HyperLogLog,
+    month_start,
+)
+from src.cogs._jokes import (
+    INGEST_TIMEOUT,
+    ingest_meme,
+    Joke,
+    JokeMessages,
+    JokeStore,
+    MemeStore,
+)
+from src.cogs._stats import csv_stats, SAMPLE_SIZE, STATS_TIMEOUT
 from src.constants import *
 from src.engine import send_and_bin, utils
 
-# supported operators
-OPS = {
-    ast.Add: op.add,
-    ast.Sub: op.sub,
-    ast.Mult: op.mul,
-    ast.FloorDiv: op.floordiv,
-    ast.Mod: op.mod,
-    ast.Div: op.truediv,
-    ast.Pow: op.pow,
-    ast.BitXor: op.xor,
-    ast.USub: op.neg,
-    "abs": abs,
-    "π": math.pi,
-    "τ": math.tau,
-    "i": 1j,
-    "fact": factorial,
-}
-
-for name in dir(math):
-    if not name.startswith("_"):
-        OPS[name] = getattr(math, name)
-
-
-@dataclass
-class Joke(yaml.YAMLObject):
-    yaml_tag = "Joke"
-    yaml_dumper = yaml.SafeDumper
-    yaml_loader = yaml.SafeLoader
-    joke: str
-    joker: int
-    likes: Set[int] = field(default_factory=set)
-    dislikes: Set[int] = field(default_factory=set)
-    file: str = None
-
-
-HUG_RE = re.compile(r"^(?P<hugger>\d+) -> (?P<hugged>\d+) \| (?P<text>.*)$")
-
-
-class Hug:
-    def __init__(self, hugger, hugged, text):
-        self.hugger = hugger
-        self.hugged = hugged
-        self.text = text
-
-    @classmethod
-    def from_str(cls, line: str):
-        match = HUG_RE.match(line)
-        if not match:
-            raise ValueError(f"'{line}' is not a valid hug format.")
-        hugger = int(match.group("hugger"))
-        hugged = int(match.group("hugged"))
-        text = match.group("text")
-
-        return cls(hugger, hugged, text)
-
-    def __repr__(self):
-        return f"{self.hugger} -> {self.hugged} | {self.text}"
-
 
 class MiscCog(CustomCog, name="Divers"):
     class Config(CogConfig):
         fractals_generated: int = 0
+        approximate_hugs: bool = False
+        __approximate_hugs__ = (
+            "Estimate the number of distinct huggers in the hug leaderboard, "
+            "using little memory even with a huge number of hugs."
+        )
+        weighted_jokes: bool = False
+        __weighted_jokes__ = (
+            "Pick random jokes with more likes more often, "
+            "instead of all jokes equally often."
+        )
+        meme_budget: int = 500_000
+        __meme_budget__ = (
+            "Maximum size of the images of new jokes, in bytes. "
+            "Larger images are compressed and downsized."
+        )
 
     def __init__(self, bot: CustomBot):
         super().__init__(bot)
-        self.computing = False
+        self.jokes = JokeStore(File.JOKES_V2, File.JOKES_JOURNAL)
+        self.joke_messages = JokeMessages(File.JOKE_MESSAGES)
+        self.memes = MemeStore(File.MEMES, File.MEME_URLS)
+        self.calc_sandbox = CalcSandbox()
+        self.fractal_pool = worker_pool("fractal", os.cpu_count() or 1)
+        self.fractal_queue = FairQueue(
+            FRACTAL_BURST, FRACTAL_COOLDOWN, FRACTAL_MAX_PENDING
+        )
+        self.idle_fractal_workers = FRACTAL_CONCURRENCY
+        self.fractal_workers = [
+            bot.loop.create_task(self.fractal_worker())
+            for _ in range(FRACTAL_CONCURRENCY)
+        ]
         self.hugs = self.get_hugs()
+        self.leaderboards = {}
+        """self.leaderboards[guild_id] = HugLeaderboard, built on first use"""
+        self.timeline = None
+        self.graphs = {}
+        """self.graphs[guild_id] = HugGraph, built on first use"""
+        self.graph_stats = {}
+        """self.graph_stats[guild_id] = last HugGraphStats computed"""
+
+    def cog_unload(self):
+        self.jokes.compact()
+        for task in self.fractal_workers:
+            task.cancel()
 
     # ----------------- Hugs ---------------- #
 
@@ -211,7 +216,7 @@ class MiscCog(CustomCog, name="Divers"):
     async def hug_back(self, ctx: Context):
         hugger = ctx.author.id
 
-        last_hug: Hug = get(reversed(self.hugs), hugged=hugger)
+        last_hug: Hug = self.hugs.last_received(hugger)
         if not last_hug:
             return await ctx.send(
                 f"No one has ever hugged {ctx.author.mention}, we have to fix it!"
@@ -224,18 +229,47 @@ class MiscCog(CustomCog, name="Divers"):
 
         await ctx.invoke(self.hug, str(last_hug.hugger))
 
-    @command(name="hug-stats", aliases=["hs"])
+    @command(
+        name="hug-stats",
+        aliases=["hs"],
+        usage="[member] [--since 7d | --month] | trending | graph",
+    )
     # @commands.has_role(Role.PRETRESSE_CALINS)
     @check_role(Role.MODO)
-    async def hugs_stats_cmd(self, ctx: Context, who: Member = None):
-        """(priestess of hugs) posts who is the most warm"""
+    async def hugs_stats_cmd(self, ctx: Context, *args):
+        """
+        (priestess of hugs) posts who is the most warm
 
-        if who is None:
-            await self.send_all_hug_stats(ctx)
+        With `--since 7d` (or 30s, 15m, 12h, 2w) or `--month`, only recent hugs
+        are counted.
+        `trending` shows who gave the most hugs this week.
+        `graph` shows who hugs each other and who gets the warmest hugs.
+        """
+
+        args = list(args)
+        if args == ["trending"]:
+            return await self.send_trending_huggers(ctx)
+        if args == ["graph"]:
+            return await self.send_hug_graph(ctx)
+
+        since = None
+        if "--month" in args:
+            args.remove("--month")
+            since = month_start(int(time()))
+        if "--since" in args:
+            i = args.index("--since")
+            if i + 1 == len(args):
+                raise CozyError("`--since` needs a duration, like `7d`.")
+            since = time() - parse_duration(args[i + 1])
+            del args[i : i + 2]
+
+        if args:
+            who = await MemberConverter().convert(ctx, " ".join(args))
+            await self.send_hugs_stats_for(ctx, who, since)
         else:
-            await self.send_hugs_stats_for(ctx, who)
+            await self.send_all_hug_stats(ctx, since)
 
-    async def send_all_hug_stats(self, ctx):
+    async def send_all_hug_stats(self, ctx, since=None):
         medals = [
             ":first_place:",
             ":second_place:",
@@ -245,38 +279,27 @@ class MiscCog(CustomCog, name="Divers"):
         ]
         ranks = ["Big Teddy Bear", "Little Panda", "Teddy Bear"]
 
+        footer = ""
+        if since is None:
+            descr = f"Total number of hugs {len(self.hugs)} {Emoji.HEART}"
+            board = await self.leaderboard(ctx.guild)
+            top = board.top(13)
+            if board.approximate:
+                footer = (
+                    "Distinct huggers are estimated, with a typical error "
+                    f"of {HyperLogLog.ERROR:.1%}."
+                )
+        else:
+            date = datetime.utcfromtimestamp(since).ctime()
+            descr = f"Hugs received since {date} UTC"
+            top = await self.recent_top(ctx, since, 13)
+
         embed = discord.Embed(
             title="More hugged prize",
             color=discord.Colour.magenta(),
-            description=f"Total number of hugs {len(self.hugs)} {Emoji.HEART}",
+            description=descr,
         )
 
-        everyone = ctx.guild.default_role.id
-        everyone_hugs = 0
-        everyone_diff = set()
-        stats = Counter()
-        diffs = defaultdict(set)
-        for h in self.hugs:
-            if h.hugged == everyone:
-                everyone_hugs += 1
-                everyone_diff.add(h.hugger)
-            else:
-                if h.hugged != h.hugger:
-                    stats[h.hugged] += 1
-                    diffs[h.hugged].add(h.hugger)
-
-                role: discord.Role = get(ctx.guild.roles, id=h.hugged)
-                if role is not None:
-                    for m in role.members:
-                        if m.id != h.hugger:
-                            stats[m.id] += 1
-                            diffs[m.id].add(h.hugger)
-
-        for m, d in diffs.items():
-            stats[m] += len(everyone_diff.union(d)) * 42 + everyone_hugs
-
-        top = sorted(list(stats.items()), key=itemgetter(1), reverse=True)
-
         for i in range(min(3, len(top))):
             m = medals[i]
             r = ranks[i]
@@ -299,9 +322,90 @@ class MiscCog(CustomCog, name="Divers"):
         if top8to13:
             embed.add_field(name="Ball of duck wool", value=top8to13)
 
+        if footer:
+            embed.set_footer(text=footer)
+
         await ctx.send(embed=embed)
 
-    async def send_hugs_stats_for(self, ctx: Context, who: discord.Member):
+    async def recent_top(self, ctx, since, k):
+        """The k members that received the most hugs since a timestamp."""
+
+        everyone = ctx.guild.default_role.id
+        scores = Counter()
+        timeline = await self.hug_timeline()
+        for id_, n in timeline.received(since).items():
+            if id_ == everyone:
+                continue  # Same for everyone
+            scores[id_] += n
+            role = ctx.guild.get_role(id_)
+            if role is not None:
+                for m in role.members:
+                    scores[m.id] += n
+
+        return scores.most_common(k)
+
+    async def send_trending_huggers(self, ctx: Context):
+        now = time()
+        timeline = await self.hug_timeline()
+        week = timeline.given(now - 7 * DAY)
+        previous = timeline.given(now - 14 * DAY, now - 7 * DAY)
+
+        top = [(id_, n) for id_, n in week.most_common() if ctx.guild.get_member(id_)]
+        lines = "\n".join(
+            f"{self.name_for(ctx, id_)} : {n} :hugging: ({n - previous[id_]:+} "
+            "from last week)"
+            for id_, n in top[:10]
+        )
+
+        embed = discord.Embed(
+            title="Trending huggers",
+            color=discord.Colour.magenta(),
+            description=lines or "No one hugged this week... :broken_heart:",
+        )
+        await ctx.send(embed=embed)
+
+    async def send_hug_graph(self, ctx: Context):
+        with ctx.channel.typing():
+            stats = await self.hug_graph_stats(ctx.guild)
+
+        members = lambda ids: [i for i in ids if ctx.guild.get_member(i)]
+
+        warmest = sorted(members(stats.warmth), key=stats.warmth.get, reverse=True)
+        warmth = "\n".join(
+            f"{self.name_for(ctx, id_)} : {stats.warmth[id_]:.2f} :fire:"
+            for id_ in warmest[:10]
+        )
+
+        pairs = [p for p in stats.mutual_pairs if len(members(p[:2])) == 2]
+        pairs = "\n".join(
+            f"{self.name_for(ctx, a)} :people_hugging: {self.name_for(ctx, b)} : {n}"
+            for a, b, n in pairs[:10]
+        )
+
+        communities = "\n".join(
+            f"{len(group)} members: "
+            + french_join([self.name_for(ctx, i) for i in group[:8]], "and")
+            + " ..." * (len(group) > 8)
+            for group in (members(c) for c in stats.communities[:5])
+            if len(group) > 1
+        )
+
+        embed = discord.Embed(
+            title="Hug graph",
+            color=discord.Colour.magenta(),
+            description="Warmth counts more the hugs from warm members, "
+            "1 is average.",
+        )
+        embed.add_field(name="Warmest", value=warmth or "No one", inline=False)
+        embed.add_field(name="Mutual hugs", value=pairs or "None", inline=False)
+        embed.add_field(
+            name="Communities",
+            value=with_max_len(communities, 1000) or "None",
+            inline=False,
+        )
+        await ctx.send(embed=embed)
+
+    async def send_hugs_stats_for(self, ctx: Context, who: discord.Member, since=None):
 
         given = self.hugs_given(ctx, who.id)
         received = self.hugs_received(ctx, who.id)
@@ -342,21 +446,30 @@ class MiscCog(CustomCog, name="Divers"):
                 v = 2 ** v
             embed.add_field(name=f, value=f"{v} {heart}")
 
+        if since is not None:
+            timeline = await self.hug_timeline()
+            targets = self.role_ids(ctx, who.id) | {who.id}
+            received = timeline.received(since)
+            date = datetime.utcfromtimestamp(since).strftime("%d/%m/%Y")
+            embed.add_field(
+                name=f"Given since {date}", value=timeline.given(since)[who.id]
+            )
+            embed.add_field(
+                name=f"Received since {date}", value=sum(received[t] for t in targets)
+            )
+
         await ctx.send(embed=embed)
 
-    def ris(self, ctx: Context, id, role_or_member_id):
-        """Whether the id is the same member or a member that has the given role."""
-        if id == role_or_member_id:
-            return True
+    @staticmethod
+    def role_ids(ctx: Context, member_id):
+        """The ids of the roles of a member, empty if they are not in the guild."""
 
-        member: Member = get(ctx.guild.members, id=id)
+        member: Member = ctx.guild.get_member(member_id)
 
         if member is None:
-            return False
-
-        role = get(member.roles, id=role_or_member_id)
+            return set()
 
-        return role is not None
+        return {r.id for r in member.roles}
 
     @staticmethod
     def heart_for_stat(v):
@@ -400,87 +513,127 @@ class MiscCog(CustomCog, name="Divers"):
         return 42 * len(diffs) + len(received)
 
     def hugs_given(self, ctx, who_id):
-        eq = partial(self.ris, ctx, who_id)
-        return [h for h in self.hugs if eq(h.hugger) and not eq(h.hugged)]
+        return self.hugs.given(who_id, self.role_ids(ctx, who_id))
 
     def hugs_received(self, ctx, who_id):
-        eq = partial(self.ris, ctx, who_id)
-        return [h for h in self.hugs if eq(h.hugged) and not eq(h.hugger)]
+        return self.hugs.received(who_id, self.role_ids(ctx, who_id))
 
     def auto_hugs(self, ctx, who_id):
-        eq = partial(self.ris, ctx, who_id)
-        return [h for h in self.hugs if eq(h.hugged) and eq(h.hugger)]
+        return self.hugs.self_hugs(who_id, self.role_ids(ctx, who_id))
+
+    async def leaderboard(self, guild: discord.Guild) -> HugLeaderboard:
+        """The leaderboard of the guild, built in a worker on first use."""
+
+        approximate = self.get_conf(guild, "approximate_hugs")
+        board = self.leaderboards.get(guild.id)
+        if board is None or board.approximate != approximate:
+
+            def members_of(id_):
+                role = guild.get_role(id_)
+                return role and [m.id for m in role.members]
+
+            records = self.hugs.columns()
+            everyone = guild.default_role.id
+            roles = {
+                id_: members_of(id_)
+                for id_ in set(records[:, 1].tolist())
+                if id_ != everyone and guild.get_role(id_)
+            }
+            board = await run_cpu_bound(
+                build_leaderboard, records, everyone, roles, approximate
+            )
+            board.members_of = members_of
+            # Hugs given while it was built
+            for hugger, hugged, _ in self.hugs.records(len(records)):
+                board.add(Hug(hugger, hugged, ""))
+            self.leaderboards[guild.id] = board
+
+        return board
+
+    async def hug_timeline(self) -> HugTimeline:
+        """Hugs counted per day and month, built in a worker on first use."""
+
+        if self.timeline is None:
+            records = self.hugs.columns()
+            timeline = await run_cpu_bound(build_timeline, records)
+            timeline.extend(self.hugs.records(len(records)))
+            self.timeline = timeline
+        return self.timeline
+
+    async def hug_graph(self, guild: discord.Guild) -> HugGraph:
+        """The graph of hugs of the guild, built in a worker on first use."""
+
+        graph = self.graphs.get(guild.id)
+        if graph is None:
+            records = self.hugs.columns()
+            graph = await run_cpu_bound(
+                build_graph, records, {role.id for role in guild.roles}
+            )
+            graph.is_member = lambda id_: guild.get_role(id_) is None
+            graph.extend(self.hugs.records(len(records)))
+            self.graphs[guild.id] = graph
+        return graph
+
+    async def hug_graph_stats(self, guild: discord.Guild) -> HugGraphStats:
+        """Analytics of the hug graph, recomputed in a worker if there are new hugs."""
+
+        graph = await self.hug_graph(guild)
+        stats = self.graph_stats.get(guild.id)
+        if stats is None or stats.version != graph.version:
+            # Sparse linear algebra, this keeps the event loop free
+            stats = await run_cpu_bound(graph.snapshot().compute)
+            self.graph_stats[guild.id] = stats
+        return stats
 
     @staticmethod
     def get_hugs():
-        File.HUGS.touch()
-        lines = File.HUGS.read_text().strip().splitlines()
-        return [Hug.from_str(l) for l in lines]
+        if File.HUGS.exists() and HugStore.is_empty(File.HUGS_LOG):
+            return HugStore.convert(File.HUGS, File.HUGS_LOG)
+        return HugStore(File.HUGS_LOG)
 
     def add_hug(self, hugger: int, hugged: int, text):
-        File.HUGS.touch()
-        with open(File.HUGS, "a") as f:
-            f.write(f"{hugger} -> {hugged} | {text}\n")
-        self.hugs.append(Hug(hugger, hugged, text))
-
-    # ---------------- Jokes ---------------- #
-
-    @staticmethod
-    def load_jokes() -> List[Joke]:
-        # Ensure it exists
-        File.JOKES_V2.touch()
-        with open(File.JOKES_V2) as f:
-            jokes = list(yaml.safe_load_all(f))
-
-        return jokes
-
-    @staticmethod
-    def save_jokes(jokes):
-        File.JOKES_V2.touch()
-        with open(File.JOKES_V2, "w") as f:
-            yaml.safe_dump_all(jokes, f)
+        hug = Hug(hugger, hugged, text, time())
+        self.hugs.add(hug)
+        for board in self.leaderboards.values():
+            board.add(hug)
+        if self.timeline is not None:
+            self.timeline.add(hugger, hugged, int(hug.time))
+        for graph in self.graphs.values():
+            graph.add(hugger, hugged)
 
     # ---------------- Joke ----------------- #
 
     @group(name="joke", invoke_without_command=True, case_insensitive=True)
     async def joke(self, ctx: Context, id=None):
-        """Quietly makes a random joke."""
+        """Quietly makes a random joke, or the one at the given rank."""
 
         m: discord.Message = ctx.message
         await m.delete()
 
-        jokes = self.load_jokes()
-        if id is not None:
-            id = int(id)
-            joke_id = id
-            jokes = sorted(
-                jokes, key=lambda j: len(j.likes) - len(j.dislikes), reverse=True
-            )
-        else:
-            joke_id = random.randrange(len(jokes))
-
         try:
-            joke = jokes[joke_id]
-        except IndexError:
+            if id is not None:
+                joke_id = self.jokes.ranked(int(id))
+            else:
+                weighted = self.get_conf(ctx.guild, "weighted_jokes")
+                joke_id = self.jokes.random(weighted)
+            joke = self.jokes[joke_id]
+        except (IndexError, ValueError):
             raise CozyError("There are no jokes with this ID.")
 
         if joke.file:
-            file = discord.File(File.MEMES / joke.file)
+            message = await self.send_meme(ctx, joke.joke, joke.file)
         else:
-            file = None
-
-        message: discord.Message = await ctx.send(joke.joke, file=file)
+            message = await ctx.send(joke.joke)
 
+        self.watch_joke_votes(joke_id, message)
         await message.add_reaction(Emoji.PLUS_1)
         await message.add_reaction(Emoji.MINUS_1)
-        await self.wait_for_joke_reactions(joke_id, message)
 
     @joke.command(name="new")
     @send_and_bin
     async def new_joke(self, ctx: Context):
         """Add a joke for the joke contest."""
-        jokes = self.load_jokes()
-        joke_id = len(jokes)
+        joke_id = len(self.jokes)
 
         author: discord.Member = ctx.author
         message: discord.Message = ctx.message
@@ -491,73 +644,146 @@ class MiscCog(CustomCog, name="Divers"):
 
         if message.attachments:
             file: discord.Attachment = message.attachments[0]
-            joke.file = str(f"{joke_id}-{file.filename}")
-            await file.save(File.MEMES / joke.file)
+            original = await file.read()
+            data, filename, thumbnail = await run_cpu_bound(
+                ingest_meme,
+                original,
+                file.filename,
+                self.get_conf(ctx.guild, "meme_budget"),
+                timeout=INGEST_TIMEOUT,
+            )
+            joke.file = self.memes.save(data, filename, thumbnail)
+            # The attachment can be reused only if we kept it as is
+            if data == original and not self.memes.url(joke.file):
+                self.memes.remember(joke.file, file.url)
         elif not msg.strip():
             return "You can't add an empty joke..."
 
-        jokes.append(joke)
-        self.save_jokes(jokes)
+        self.jokes.add(joke)
+        self.watch_joke_votes(joke_id, message)
         await message.add_reaction(Emoji.PLUS_1)
         await message.add_reaction(Emoji.MINUS_1)
 
-        await self.wait_for_joke_reactions(joke_id, message)
-
-    async def wait_for_joke_reactions(self, joke_id, message):
-        # D: is the `u` parameter used
-        def check(reaction: discord.Reaction, u):
-            return (message.id == reaction.message.id) and str(reaction.emoji) in (
-                Emoji.PLUS_1,
-                Emoji.MINUS_1,
-            )
+    async def send_meme(self, ctx: Context, text, name) -> discord.Message:
+        """
+        Send the text with a file of the meme store.
 
-        start = time()
-        end = start + 24 * 60 * 60 * 5  # 5 days
-        while time() < end:
+        Images are shown from the URL of a previous upload when it still
+        works, and are uploaded again otherwise.
+        """
 
+        url = self.memes.url(name)
+        if url:
             try:
-                reaction, user = await self.bot.wait_for(
-                    "reaction_add", check=check, timeout=end - time()
-                )
-            except asyncio.TimeoutError:
-                return
+                async with aiohttp.ClientSession() as session:
+                    async with session.head(url) as resp:
+                        expired = resp.status != 200
+            except aiohttp.ClientError:
+                expired = True
+            if not expired:
+                return await ctx.send(text, embed=discord.Embed().set_image(url=url))
+            self.memes.forget(name)
+
+        message = await ctx.send(text, file=discord.File(self.memes.path(name)))
+        if message.attachments:
+            self.memes.remember(name, message.attachments[0].url)
+        return message
 
-            if user.id == BOT:
-                continue
+    def watch_joke_votes(self, joke_id, message: discord.Message):
+        """Count the reactions on the message as votes for the joke."""
+        self.joke_messages.add(message.id, joke_id)
 
-            jokes = self.load_jokes()
-            if str(reaction.emoji) == Emoji.PLUS_1:
-                jokes[joke_id].likes.add(user.id)
-            else:
-                jokes[joke_id].dislikes.add(user.id)
+    @Cog.listener()
+    async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
+        self.on_joke_reaction(payload)
 
-            self.save_jokes(jokes)
+    @Cog.listener()
+    async def on_raw_reaction_remove(self, payload: discord.RawReactionActionEvent):
+        self.on_joke_reaction(payload, remove=True)
+
+    def on_joke_reaction(self, payload: discord.RawReactionActionEvent, remove=False):
+        joke_id = self.joke_messages.get(payload.message_id)
+        if joke_id is None or payload.user_id == BOT:
+            return
+
+        emoji = str(payload.emoji)
+        if emoji in (Emoji.PLUS_1, Emoji.MINUS_1):
+            self.jokes.vote(joke_id, payload.user_id, emoji == Emoji.PLUS_1, remove)
 
     @joke.command(name="top")
     @check_role(Role.MODO)
     async def best_jokes(self, ctx: Context):
         """Displays the list of jokes ."""
 
-        jokes = self.load_jokes()
+        embed = discord.Embed(title="Best jokes.")
+        jokes = [self.jokes[joke_id] for joke_id in self.jokes.top(10)]
+        shown, file = self.set_joke_thumbnail(embed, jokes)
+        for i, joke in enumerate(jokes):
+            self.add_joke_field(ctx, embed, i, joke, thumbnail=joke is shown)
 
-        s = sorted(jokes, key=lambda j: len(j.likes) - len(j.dislikes), reverse=True)
+        await ctx.send(embed=embed, file=file)
 
-        embed = discord.Embed(title="Best jokes.")
-        for i, joke in enumerate(s[:10]):
-            who = get(ctx.guild.members, id=joke.joker)
+    @joke.command(name="search")
+    async def search_jokes(self, ctx: Context, *, words):
+        """Displays the jokes that best match the words."""
 
-            text = joke.joke
-            if joke.file:
-                text += " - no image included - "
+        matches = self.jokes.search(words, 10)
+        if not matches:
+            raise CozyError("No joke matches these words.")
 
-            name = who.display_name if who else "Unknown"
-            embed.add_field(
-                name=f"{i} - {name} - {len(joke.likes)} :heart: {len(joke.dislikes)} :broken_heart:",
-                value=text,
-                inline=False,
+        embed = discord.Embed(title=f"Jokes about {with_max_len(words, 200)}")
+        shown, file = self.set_joke_thumbnail(
+            embed, [self.jokes[joke_id] for _, joke_id in matches]
+        )
+        for relevance, joke_id in matches:
+            rank = self.jokes.rank(joke_id)
+            joke = self.jokes[joke_id]
+            self.add_joke_field(
+                ctx,
+                embed,
+                rank,
+                joke,
+                f" - match {relevance:.2f}",
+                thumbnail=joke is shown,
             )
 
-        await ctx.send(embed=embed)
+        await ctx.send(embed=embed, file=file)
+
+    def set_joke_thumbnail(
+        self, embed: discord.Embed, jokes: List[Joke]
+    ) -> Tuple[Optional[Joke], Optional[discord.File]]:
+        """
+        Show the thumbnail of the first of the jokes that has one in the embed.
+
+        Returns the joke and the file of the thumbnail, to send with the embed.
+        """
+
+        for joke in jokes:
+            path = joke.file and self.memes.thumbnail_path(joke.file)
+            if path and path.exists():
+                embed.set_thumbnail(url=f"attachment://{path.name}")
+                return joke, discord.File(path)
+        return None, None
+
+    @staticmethod
+    def add_joke_field(
+        ctx: Context, embed: discord.Embed, rank, joke: Joke, extra="", thumbnail=False
+    ):
+        who = get(ctx.guild.members, id=joke.joker)
+
+        text = joke.joke
+        if thumbnail:
+            text += " - image in the thumbnail - "
+        elif joke.file:
+            text += " - no image included - "
+
+        name = who.display_name if who else "Unknown"
+        embed.add_field(
+            name=f"{rank} - {name} - {len(joke.likes)} :heart: "
+            f"{len(joke.dislikes)} :broken_heart:{extra}",
+            value=with_max_len(text, 1024),
+            inline=False,
+        )
 
     # @joke.command(name="del")
     # @check_role(Role.MODO)
@@ -610,50 +836,78 @@ class MiscCog(CustomCog, name="Divers"):
     async def fractal(self, ctx: Context, *, seed=None):
         """Draw a random fractal."""
 
-        if self.computing:
-            return await ctx.send("There is a fractal being calculated already")
+        # await ctx.respond()
+        # msg: discord.Message = ctx.message
+        # seed = msg.content[len("!fractal "):]
+        seed = seed or str(random.randint(0, 1_000_000_000))
+        guild_id = ctx.guild.id if ctx.guild else None
+        job = FractalJob(guild_id, ctx.author.id, seed, ctx)
 
-        with ctx.channel.typing():
-            try:
-                self.computing = True
+        try:
+            position = self.fractal_queue.put(job)
+        except QueueFull as e:
+            raise CozyError(str(e))
+        wait = self.fractal_queue.ready_in(job)
+        if wait > 0:
+            await ctx.send(
+                f"You can draw a fractal every {FRACTAL_COOLDOWN}s, "
+                f"yours will start in {wait:.0f}s at the earliest. "
+                f"It is number {position} in the queue."
+            )
+        elif position > self.idle_fractal_workers:
+            await ctx.send(f"Your fractal is number {position} in the queue.")
 
-                # await ctx.respond()
-                # msg: discord.Message = ctx.message
-                # seed = msg.content[len("!fractal "):]
-                seed = seed or str(random.randint(0, 1_000_000_000))
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(
-                        FRACTAL_URL.format(seed=urllib.parse.quote(seed)), timeout=120
-                    ) as resp:
-                        if resp.status != 200:
-                            print(resp)
-                            return await ctx.send(
-                                "There was a problem calculating or downloading the image..."  # D: maybe send?
-                            )
-                        data = io.BytesIO(await resp.read())
-
-                        # seed_escaped = remove_mentions_as(ctx.author, ctx.channel, seed)
-                        await ctx.send(
-                            f"Seed: {seed}",
-                            file=discord.File(data, "fractal.png"),
-                            allowed_mentions=AllowedMentions.none(),
-                        )
+    async def fractal_worker(self):
+        """Draw the fractals of the queue, one at a time."""
 
-                        if ctx.guild:
-                            conf: MiscCog.Config
-                            with self.config(ctx.guild) as conf:
-                                conf.fractals_generated += 1
+        while True:
+            job = await self.fractal_queue.get()
+            self.idle_fractal_workers -= 1
+            try:
+                await self.draw_fractal(job.ctx, job.seed)
+            except Exception as e:
+                if not isinstance(e, CommandError):
+                    e = CommandInvokeError(e)
+                self.bot.dispatch("command_error", job.ctx, e)
             finally:
-                self.computing = False
+                self.idle_fractal_workers += 1
+
+    async def draw_fractal(self, ctx: Context, seed: str):
+        with ctx.channel.typing():
+            image = await render_fractal_tiled(
+                seed, partial(self.fractal_pool.run, timeout=120)
+            )
+
+            # seed_escaped = remove_mentions_as(ctx.author, ctx.channel, seed)
+            await ctx.send(
+                f"Seed: {seed}",
+                file=discord.File(io.BytesIO(image), "fractal.png"),
+                allowed_mentions=AllowedMentions.none(),
+            )
+
+            if ctx.guild:
+                conf: MiscCog.Config
+                with self.config(ctx.guild) as conf:
+                    conf.fractals_generated += 1
 
     # ---------------- Calc ----------------- #
 
-    @command(name="calc", aliases=["="])
+    @group(name="calc", aliases=["="], invoke_without_command=True)
     async def calc_cmd(self, ctx, *args):
         """Make a simple calculus"""
+        await self.watch_calc(ctx, self._calc)
+
+    @calc_cmd.command(name="plot")
+    async def calc_plot_cmd(self, ctx: Context, *args):
+        """Plot a function, for instance: !calc plot sin(x)/x, x=-10..10"""
+        await self.watch_calc(ctx, self._plot)
+
+    async def watch_calc(self, ctx: Context, render):
+        """Show the result of a calculation, updated when the message is edited."""
+
         with_tb = ctx.author.id == OWNER
-        embed = self._calc(ctx.message.content, with_tb)
-        resp = await ctx.send(embed=embed)
+        embed, file = await render(ctx.message.content, with_tb)
+        resp = await ctx.send(embed=embed, file=file)
 
         def check(before, after):
             return after.id == ctx.message.id
@@ -666,8 +920,13 @@ class MiscCog(CustomCog, name="Divers"):
             except asyncio.TimeoutError:
                 break
 
-            embed = self._calc(after.content, with_tb)
-            await resp.edit(embed=embed)
+            embed, file = await render(after.content, with_tb)
+            if file or resp.attachments:
+                # Attachments cannot be edited
+                await resp.delete()
+                resp = await ctx.send(embed=embed, file=file)
+            else:
+                await resp.edit(embed=embed)
 
         # Remove the "You may edit your message"
         embed.set_footer()
@@ -676,77 +935,90 @@ class MiscCog(CustomCog, name="Divers"):
         except discord.NotFound:
             pass
 
-    def _calc(self, query: str, with_tb=False):
+    @calc_cmd.command(name="stats")
+    async def calc_stats_cmd(self, ctx: Context):
+        """Statistics of the columns of the attached CSV file."""
+
+        if not ctx.message.attachments:
+            raise CozyError("Attach a CSV file to your message.")
+        file: discord.Attachment = ctx.message.attachments[0]
+
+        async with ctx.typing():
+            # The file is streamed in the thread, never fully in memory
+            columns = await run_cpu_bound(
+                csv_stats, file.url, pool="threads", timeout=STATS_TIMEOUT
+            )
+
+        if not columns:
+            raise CozyError("There are no numbers in this file.")
+
+        embed = discord.Embed(
+            title=f"Statistics of {file.filename}",
+            description="Quantiles and histograms are estimated "
+            f"on a sample of {SAMPLE_SIZE} rows.",
+            color=EMBED_COLOR,
+        )
+        for column in columns[:25]:
+            embed.add_field(
+                name=with_max_len(column.name, 256), value=str(column), inline=False
+            )
+        await ctx.send(embed=embed)
+
+    @calc_cmd.command(name="cache")
+    async def calc_cache_cmd(self, ctx: Context):
+        """Hit rate of the cache of calculations."""
 
-        for prefix in (PREFIX + " ", PREFIX, "calc", "="):
+        cache = self.calc_sandbox.cache
+        await ctx.send(
+            f"{len(cache)}/{cache.size} results cached. "
+            f"{cache.hits} hits, {cache.misses} misses: "
+            f"{cache.hit_rate:.0%} hit rate."
+        )
+
+    @staticmethod
+    def strip_calc_prefix(query: str, *subcommands):
+        for prefix in (PREFIX + " ", PREFIX, "calc", "=", *subcommands):
+            query = query.strip()
             if query.startswith(prefix):
                 query = query[len(prefix) :]
-        # Replace implicit multiplication by explicit *
-        query = re.sub(r"\b((\d)+(\.\d+)?)(?P<name>[a-zA-Z]+)\b", r"\1*\4", query)
+        return normalize(query)
 
-        query = query.strip().strip("`")
+    async def _calc(self, query: str, with_tb=False):
+        query = self.strip_calc_prefix(query)
+        result = await self.calc_sandbox.run(query)
+        return self.calc_embed(query, result, with_tb), None
 
-        ex = None
-        result = 42
-        try:
-            result = self._eval(ast.parse(query, mode="eval").body)
-        except Exception as e:
-            ex = e
+    async def _plot(self, query: str, with_tb=False):
+        query = self.strip_calc_prefix(query, "plot")
+        result = await self.calc_sandbox.plot(query)
 
-        if isinstance(result, complex):
-            if abs(result.imag) < 1e-12:
-                result = result.real
-            else:
-                r, i = result.real, result.imag
-                r = r if abs(int(r) - r) > 1e-12 else int(r)
-                i = i if abs(int(i) - i) > 1e-12 else int(i)
-                if not r:
-                    result = f"{i if i != 1 else ''}i"
-                else:
-                    result = f"{r}{i if i != 1 else '':+}i"
-        if isinstance(result, float):
-            result = round(result, 12)
+        embed = self.calc_embed(query, result, with_tb)
+        if result.image is None:
+            return embed, None
+        embed.set_image(url="attachment://plot.png")
+        return embed, discord.File(io.BytesIO(result.image), "plot.png")
 
+    @staticmethod
+    def calc_embed(query, result: CalcResult, with_tb=False):
         embed = discord.Embed(
             title=discord.utils.escape_markdown(query), color=EMBED_COLOR
         )
         # embed.add_field(name="Entrée", value=f"`{query}`", inline=False)
-        embed.add_field(
-            name="Valeur", value=f"`{with_max_len(str(result), 1022)}`", inline=False
-        )
-        if ex and with_tb:
+        if "\n" in result.value:  # Arrays
+            value = f"```\n{with_max_len(result.value, 1016)}```"
+        else:
+            value = f"`{with_max_len(result.value, 1022)}`"
+        embed.add_field(name="Valeur", value=value, inline=False)
+        if result.error and with_tb:
+            embed.add_field(name="Erreur", value=result.error, inline=False)
+        if result.trace and with_tb:
             embed.add_field(
-                name="Erreur", value=f"{ex.__class__.__name__}: {ex}", inline=False
+                name="Traceback", value=f"```\n{with_max_len(result.trace, 1000)}```"
             )
-            trace = io.StringIO()
-            traceback.print_exception(type(ex), ex, ex.__traceback__, file=trace)
-            trace.seek(0)
-            embed.add_field(name="Traceback", value=f"```\n{trace.read()}```")
         embed.set_footer(text="You may edit your message")
 
         return embed
 
-    def _eval(self, node):
-        if isinstance(node, ast.Num):  # <number>
-            return node.n
-        elif isinstance(node, ast.BinOp):  # <left> <operator> <right>
-            return OPS[type(node.op)](self._eval(node.left), self._eval(node.right))
-        elif isinstance(node, ast.UnaryOp):  # <operator> <operand> e.g., -1
-            return OPS[type(node.op)](self._eval(node.operand))
-        elif isinstance(node, ast.Call):
-            if isinstance(node.func, ast.Name):
-                return OPS[node.func.id](
-                    *(self._eval(n) for n in node.args),
-                    **{k.arg: self._eval(k.value) for k in node.keywords},
-                )
-        elif isinstance(node, ast.Name):
-            return OPS[node.id]
-
-        fields = ", ".join(
-            f"{k}={getattr(node, k).__class__.__name__}" for k in node._fields
-        )
-        raise TypeError(f"Node type not supported: {node.__class__.__name__}({fields})")
-
     @command(name="Diego", aliases=[OWNER_NAME], hidden=True)
     async def diego_cmd(self, ctx):
         msg = "He is my daddy! :smiling_face_with_3_hearts:"
@@ -1,9 +1,25 @@
 import ast
+import asyncio
+import heapq
+import operator as op
 import re
+import traceback
 from collections import defaultdict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
 from itertools import chain
 from operator import attrgetter
-from typing import Iterator, Optional, Set, Tuple, Union
+from time import perf_counter, time
+from typing import (
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 import discord
 import yaml
@@ -14,16 +30,76 @@ from discord.ext.commands import Cog, Context, group, has_role
 from src.constants import *
 from engine import check_role, CustomBot, CustomCog, CogConfig
 from engine.errors import CozyError
-from engine.utils import confirm, french_join, mentions_to_id, myembed, report_progress
+from engine.utils import (
+    confirm,
+    DURATION_RE,
+    DURATION_UNITS,
+    format_duration,
+    french_join,
+    mentions_to_id,
+    myembed,
+    report_progress,
+)
 
 RoleOrChan = Union[discord.Role, GuildChannel]
 
 
+TIME_FACTS = {
+    "joined": attrgetter("joined_at"),
+    "boosting": attrgetter("premium_since"),
+}
+"""Time-dependent facts usable in rules and how to get their start from a member."""
+COMPARISONS = {ast.Gt: ">", ast.GtE: ">=", ast.Lt: "<", ast.LtE: "<="}
+COMPARE_OPS = {ast.Gt: op.gt, ast.GtE: op.ge, ast.Lt: op.lt, ast.LtE: op.le}
+
+
+class RuleInput(NamedTuple):
+    """Everything a rule can depend on, for one member at one instant."""
+
+    roles: Set[int]
+    since: Dict[str, Optional[datetime]]
+    now: datetime
+
+    @classmethod
+    def of(cls, member: Member, now: datetime = None):
+        return cls(
+            {r.id for r in member.roles},
+            {name: fact(member) for name, fact in TIME_FACTS.items()},
+            now or datetime.utcnow(),
+        )
+
+
 class Rule:
+    """
+    A boolean expression of roles and time predicates.
+
+    Roles are given by their id or mention, and combined with
+    `and`, `or` and `not`. Time predicates compare how long a fact
+    has been true with a duration, like `joined > 30d` or `boosting >= 2w`.
+    A fact can also be used alone, like `boosting`.
+    """
+
     def __init__(self, rule: str):
         # Normalize mentions
         self.string = mentions_to_id(rule)
-        self.ast = ast.parse(self.string, mode="eval").body
+        # Durations are not valid python, so we convert them to seconds.
+        # Malformed ones, like 1.5d, are left as is and are syntax errors.
+        python = DURATION_RE.sub(
+            lambda m: str(int(m.group(1)) * DURATION_UNITS[m.group(2)]), self.string
+        )
+        try:
+            self.ast = ast.parse(python, mode="eval").body
+        except SyntaxError:
+            raise CozyError(
+                f"`{rule}` is not a valid rule. Durations are whole numbers "
+                f"followed by a unit in {', '.join(DURATION_UNITS)}, like `30d`."
+            )
+        self.time_predicates = [
+            node for node in ast.walk(self.ast) if isinstance(node, ast.Compare)
+        ]
+        # Check them now rather than on the first time transition
+        for node in self.time_predicates:
+            self._time_predicate(node)
 
     def __repr__(self):
         return self.string
@@ -31,23 +107,31 @@ class Rule:
     def with_mentions(self):
         return re.sub(r"([0-9]{18,21})", r"<@&\1>", self.string)
 
-    def eval(self, member: Member):
-        return self._eval({r.id for r in member.roles}, self.ast)
+    def eval(self, member: Member, now: datetime = None):
+        return self._eval(RuleInput.of(member, now), self.ast)
 
-    def _eval(self, roles: Set[int], node):
+    def _eval(self, inp: RuleInput, node):
 
         if isinstance(node, ast.Num):  # Role ID
-            return node.n in roles
+            return node.n in inp.roles
         elif isinstance(node, ast.BoolOp):  # <left> <operator> <right>
             if isinstance(node.op, ast.And):
-                return all(self._eval(roles, v) for v in node.values)
+                return all(self._eval(inp, v) for v in node.values)
             elif isinstance(node.op, ast.Or):
-                return any(self._eval(roles, v) for v in node.values)
-        elif isinstance(node, ast.Compare):
-            pass
+                return any(self._eval(inp, v) for v in node.values)
+        elif isinstance(node, ast.Compare):  # <fact> <comparison> <duration>
+            fact, duration = self._time_predicate(node)
+            start = inp.since[fact]
+            if start is None:
+                return False
+            elapsed = (inp.now - start).total_seconds()
+            return COMPARE_OPS[type(node.ops[0])](elapsed, duration)
+        elif isinstance(node, ast.Name):  # <fact>
+            if node.id in TIME_FACTS:
+                return inp.since[node.id] is not None
         elif isinstance(node, ast.UnaryOp):
             if isinstance(node.op, ast.Not):
-                return not self._eval(roles, node.operand)
+                return not self._eval(inp, node.operand)
 
         # noinspection PyProtectedMember
         fields = ", ".join(
@@ -57,6 +141,94 @@ class Rule:
             f"Type de noeud non supporté: {node.__class__.__name__}({fields})"
         )
 
+    @staticmethod
+    def _time_predicate(node: ast.Compare) -> Tuple[str, int]:
+        """Return the fact and the duration in seconds of a comparison node."""
+
+        if (
+            len(node.ops) != 1
+            or type(node.ops[0]) not in COMPARISONS
+            or not isinstance(node.left, ast.Name)
+            or node.left.id not in TIME_FACTS
+            or not isinstance(node.comparators[0], ast.Num)
+            or type(node.comparators[0].n) is not int
+        ):
+            raise CozyError(
+                "Comparisons must be of the form `<fact> <op> <duration>`, "
+                f"with a fact in {', '.join(TIME_FACTS)} "
+                f"and an op in {' '.join(COMPARISONS.values())}."
+            )
+
+        return node.left.id, node.comparators[0].n
+
+    def next_transition(self, member: Member, now: datetime) -> Optional[datetime]:
+        """
+        Return the next instant after now where the result may change
+        only because time passes, or None if it never will.
+        """
+
+        since = RuleInput.of(member, now).since
+        transitions = []
+        for node in self.time_predicates:
+            fact, duration = self._time_predicate(node)
+            if since[fact] is not None:
+                when = since[fact] + timedelta(seconds=duration)
+                if when > now:
+                    transitions.append(when)
+
+        return min(transitions, default=None)
+
+    def explain(self, member: Member) -> Tuple[bool, List[str]]:
+        """
+        Evaluate the rule for a member and keep a trace of every operand.
+
+        Return the result and the lines of the trace, one per node
+        of the rule, indented according to their depth.
+        """
+
+        trace = []
+        result = self._explain(RuleInput.of(member), self.ast, trace, 0)
+        return result, trace
+
+    def _explain(self, inp: RuleInput, node, trace: List[str], depth: int):
+        # Reserve the line so that operators appear before their operands
+        line = len(trace)
+        trace.append("")
+
+        if isinstance(node, ast.Num):
+            value = node.n in inp.roles
+            descr = f"<@&{node.n}>"
+        elif isinstance(node, ast.BoolOp):
+            # No short-circuit: we want to see every operand
+            values = [self._explain(inp, v, trace, depth + 1) for v in node.values]
+            if isinstance(node.op, ast.And):
+                value, descr = all(values), "and"
+            else:
+                value, descr = any(values), "or"
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            value = not self._explain(inp, node.operand, trace, depth + 1)
+            descr = "not"
+        elif isinstance(node, ast.Compare):
+            value = self._eval(inp, node)
+            fact, duration = self._time_predicate(node)
+            op = COMPARISONS[type(node.ops[0])]
+            start = inp.since[fact]
+            if start is None:
+                elapsed = "never"
+            else:
+                elapsed = timedelta(seconds=round((inp.now - start).total_seconds()))
+            descr = f"{fact} {op} {format_duration(duration)} (since {elapsed})"
+        elif isinstance(node, ast.Name):
+            value = self._eval(inp, node)
+            descr = node.id
+        else:
+            value = self._eval(inp, node)
+            descr = f"`{ast.dump(node)}`"
+
+        emoji = Emoji.CHECK if value else Emoji.CROSS
+        trace[line] = "\u2003" * depth + f"{emoji} {descr}"
+        return value
+
     def roles_implied(self):
         """Return a set of all roles referenced in this rule."""
         return {int(r.group()) for r in re.finditer("[0-9]{18,21}", self.string)}
@@ -128,15 +300,69 @@ class RuleSet(dict):
         return inputs & outputs
 
 
+@dataclass
+class RuleStats:
+    """Counters about how a rule behaves, collected since the cog was loaded."""
+
+    evaluations: int = 0
+    true: int = 0
+    time: float = 0.0
+    """Total time spent evaluating the rule, in seconds."""
+    api_calls: int = 0
+    """Number of requests to discord that were triggered by the rule."""
+
+    def __str__(self):
+        per_eval = self.time / self.evaluations * 1e6 if self.evaluations else 0
+        return (
+            f"{self.evaluations} evals, {self.true} true, "
+            f"{self.time * 1000:.2f}ms ({per_eval:.1f}µs/eval), "
+            f"{self.api_calls} API calls"
+        )
+
+
 class PermsCog(CustomCog, name="Permissions"):
     class Config(CogConfig):
         log: bool = False
         __log__ = "Send logs to the dev about role changes."
 
+    JOIN_BATCH_DELAY = 3
+    """Seconds to wait for more joins before applying the rules to the batch."""
+    JOIN_EDIT_INTERVAL = 0.5
+    """Minimum seconds between two discord requests when processing a batch of joins."""
+
     def __init__(self, bot: CustomBot):
         super().__init__(bot)
         self.rules = RuleSet.load()
         self.modifying = defaultdict(int)
+        self.stats = defaultdict(RuleStats)
+        """self.stats[role_or_chan_id] = RuleStats"""
+        self.stats_since = time()
+        self.joins = defaultdict(list)
+        """self.joins[guild_id] = members that joined and wait to be processed"""
+
+        self.timeline = []
+        """Heap of (when, guild_id, member_id) where time-dependent rules may change."""
+        self.next_check = {}
+        """self.next_check[guild_id, member_id] = when, other entries are outdated."""
+        self.timeline_changed = asyncio.Event()
+        self.timeline_task = self.bot.loop.create_task(self.run_timeline())
+
+    def cog_unload(self):
+        self.timeline_task.cancel()
+
+    def eval_rule(
+        self, item: RoleOrChan, rule: Rule, member: Member, now: datetime = None
+    ) -> bool:
+        """Evaluate the rule for the member and record it in the stats."""
+
+        start = perf_counter()
+        result = rule.eval(member, now)
+
+        stats = self.stats[item.id]
+        stats.time += perf_counter() - start
+        stats.evaluations += 1
+        stats.true += result
+        return result
 
     @Cog.listener()
     async def on_member_update(self, before: Member, after: Member):
@@ -148,7 +374,9 @@ class PermsCog(CustomCog, name="Permissions"):
 
         # Check what the rules are supposed to give
         need = {
-            item for item, rule in self.rules.items(after.guild) if rule.eval(after)
+            item
+            for item, rule in self.rules.items(after.guild)
+            if self.eval_rule(item, rule, after)
         }
         # Find what rules were giving before
         # This is better than checking which roles one has,
@@ -156,12 +384,17 @@ class PermsCog(CustomCog, name="Permissions"):
         # are not removed.
         # We care more about having enough roles than too many.
         have = {
-            item for item, rule in self.rules.items(after.guild) if rule.eval(before)
+            item
+            for item, rule in self.rules.items(after.guild)
+            if self.eval_rule(item, rule, before)
         }
 
         add = need - have
         rem = have - need
 
+        # Boosting may have changed
+        self.schedule(after)
+
         if not add and not rem:
             return  # Nothing to do !
 
@@ -190,26 +423,220 @@ class PermsCog(CustomCog, name="Permissions"):
             # Abort if two calls try to modify roles.
             return
 
+        await self.apply_rules(after, add, rem)
+
+        del self.modifying[after.id]
+
+    async def apply_rules(
+        self, member: Member, add: Set[RoleOrChan], rem: Set[RoleOrChan]
+    ):
+        """Give and remove roles and channel access to a member."""
+
         # Change roles (one by one)
-        roles_rem = rem & now
+        roles_rem = rem & set(member.roles)
         roles_add = {r for r in add if isinstance(r, discord.Role)}
 
         if roles_add:
-            await after.add_roles(*roles_add)
+            await member.add_roles(*roles_add)
         if roles_rem:
-            await after.remove_roles(*roles_rem)
+            await member.remove_roles(*roles_rem)
+        for role in roles_add | roles_rem:
+            self.stats[role.id].api_calls += 1
 
         # Change channel access
         for chan in add:
             if isinstance(chan, GuildChannel):
                 await chan.set_permissions(
-                    after, read_messages=True, send_messages=True
+                    member, read_messages=True, send_messages=True
                 )
+                self.stats[chan.id].api_calls += 1
         for chan in rem:
             if isinstance(chan, GuildChannel):
-                await chan.set_permissions(after, overwrite=None)
+                await chan.set_permissions(member, overwrite=None)
+                self.stats[chan.id].api_calls += 1
 
-        del self.modifying[after.id]
+    # -------------- Time rules --------------- #
+
+    def schedule(self, member: Member, now: datetime = None):
+        """Remember the next instant where time rules may change for the member."""
+
+        now = now or datetime.utcnow()
+        key = (member.guild.id, member.id)
+        transitions = (
+            rule.next_transition(member, now)
+            for _, rule in self.rules.items(member.guild)
+            if rule.time_predicates
+        )
+        when = min((t for t in transitions if t is not None), default=None)
+
+        if when is None:
+            self.next_check.pop(key, None)
+        elif self.next_check.get(key) != when:
+            self.next_check[key] = when
+            heapq.heappush(self.timeline, (when, *key))
+            if self.timeline[0][0] == when:
+                # Wake up the timeline, it may be sleeping for too long
+                self.timeline_changed.set()
+
+    def schedule_guild(self, guild: Guild):
+        now = datetime.utcnow()
+        for member in guild.members:
+            self.schedule(member, now)
+
+    async def run_timeline(self):
+        """
+        Re-evaluate time-dependent rules exactly when members cross a threshold.
+
+        Transitions that happened while the bot was offline are not caught,
+        `!perms fix` is there for that.
+        """
+
+        await self.bot.wait_until_ready()
+        for guild in self.bot.guilds:
+            self.schedule_guild(guild)
+
+        while True:
+            self.timeline_changed.clear()
+            if not self.timeline:
+                await self.timeline_changed.wait()
+                continue
+
+            when, guild_id, member_id = self.timeline[0]
+            delay = (when - datetime.utcnow()).total_seconds()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.timeline_changed.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self.timeline)
+            if self.next_check.get((guild_id, member_id)) != when:
+                continue  # Outdated
+            del self.next_check[guild_id, member_id]
+
+            guild = self.bot.get_guild(guild_id)
+            member = guild and guild.get_member(member_id)
+            if member is None:
+                continue
+
+            try:
+                await self.on_time_transition(member, when)
+            except Exception:
+                traceback.print_exc()
+
+    async def on_time_transition(self, member: Member, when: datetime):
+        """Update a member whose time-dependent rules may have changed at `when`."""
+
+        # Like on_member_update, we only change what the rules were giving before
+        before = when - timedelta(seconds=1)
+        after = when + timedelta(seconds=1)
+
+        need = set()
+        have = set()
+        for item, rule in self.rules.items(member.guild):
+            if rule.time_predicates:
+                if self.eval_rule(item, rule, member, after):
+                    need.add(item)
+                if self.eval_rule(item, rule, member, before):
+                    have.add(item)
+
+        add = need - have
+        rem = have - need
+        if add or rem:
+            if self.get_conf(member.guild, "log"):
+                s = lambda x: french_join(r.mention for r in x) or "None"
+                await self.bot.log(
+                    10, "Time rule update log", member.mention, Add=s(add), Rem=s(rem),
+                )
+            await self.apply_rules(member, add, rem)
+
+        self.schedule(member)
+
+    @Cog.listener()
+    async def on_member_join(self, member: Member):
+        """Give new members what the rules say, grouping the joins in batches."""
+
+        batch = self.joins[member.guild.id]
+        batch.append(member)
+        if len(batch) == 1:
+            # First of a new batch, the others will be caught by this task.
+            self.bot.loop.create_task(self.process_joins(member.guild))
+
+    async def process_joins(self, guild: Guild):
+        """Wait for the join wave to settle and apply the rules to the whole batch."""
+
+        await asyncio.sleep(self.JOIN_BATCH_DELAY)
+        # Members joining from now on start a new batch
+        batch = self.joins.pop(guild.id, [])
+        # Some may have left already
+        members = [m for m in batch if guild.get_member(m.id) is not None]
+
+        # Resolve and evaluate each rule once for the whole batch.
+        # New members have nothing given by rules yet, so we only add.
+        roles = defaultdict(set)  # member -> roles to add
+        chans = defaultdict(set)  # channel -> members to add
+        for item, rule in self.rules.items(guild):
+            for member in members:
+                if self.eval_rule(item, rule, member):
+                    if isinstance(item, discord.Role):
+                        roles[member].add(item)
+                    else:
+                        chans[item].add(member)
+
+        now = datetime.utcnow()
+        for member in members:
+            self.schedule(member, now)
+
+        if not roles and not chans:
+            return
+
+        if self.get_conf(guild, "log"):
+            s = lambda x: french_join(i.mention for i in x) or "None"
+            await self.bot.log(
+                10,
+                "Automatic rules for new members",
+                f"{len(members)} members joined.",
+                Roles=s({r for rs in roles.values() for r in rs}),
+                Channels=s(chans),
+            )
+
+        # One request per member for all its roles
+        for member, to_add in roles.items():
+            try:
+                await member.add_roles(*to_add)
+            except discord.NotFound:
+                continue  # Left in the meantime
+            except discord.HTTPException as e:
+                await self.log_join_error(member, to_add, e)
+                continue
+            for role in to_add:
+                self.stats[role.id].api_calls += 1
+            await asyncio.sleep(self.JOIN_EDIT_INTERVAL)
+
+        # One overwrite per member: a full edit of the overwrites of the
+        # channel would drop those of members that are not in the cache.
+        for chan, to_add in chans.items():
+            for member in to_add:
+                try:
+                    await chan.set_permissions(
+                        member, read_messages=True, send_messages=True
+                    )
+                except discord.HTTPException as e:
+                    await self.log_join_error(chan, [member], e)
+                else:
+                    self.stats[chan.id].api_calls += 1
+                await asyncio.sleep(self.JOIN_EDIT_INTERVAL)
+
+    async def log_join_error(self, target, items, error: discord.HTTPException):
+        """Report a failed edit of a join batch, so the rest of the batch goes on."""
+
+        await self.bot.log(
+            30,
+            "Automatic rules for new members failed",
+            f"Could not update {target.mention}: {error}",
+            For=french_join(i.mention for i in items),
+        )
 
     @staticmethod
     def input_chan_or_role(val):
@@ -242,7 +669,12 @@ class PermsCog(CustomCog, name="Permissions"):
         """
         (modo) Setup des roles ou permissions automatiques.
 
-        TODO: write doc. Note: traduir ou écrire en anglais
+        The rule combines roles with `and`, `or` and `not`, and can use
+        `joined` and `boosting`, alone or compared to a duration,
+        like `@Member and joined > 30d` or `boosting >= 2w`.
+        Durations use the units s, m, h, d and w.
+
+        Note: traduir ou écrire en anglais
         """
 
         # Parse input
@@ -275,14 +707,13 @@ class PermsCog(CustomCog, name="Permissions"):
         else:
             return {m for m in item.overwrites if isinstance(m, Member)}
 
-    @staticmethod
-    def need(item: RoleOrChan, rule: Optional[Rule]) -> Set[Member]:
+    def need(self, item: RoleOrChan, rule: Optional[Rule]) -> Set[Member]:
         """Return the set of member that need the role/channel access according to the rule."""
 
         if rule is None:
             return set()
 
-        return {m for m in item.guild.members if rule.eval(m)}
+        return {m for m in item.guild.members if self.eval_rule(item, rule, m)}
 
     async def setup_auto_rule(
         self, ctx: Context, item: RoleOrChan, rule: Optional[Rule]
@@ -340,12 +771,13 @@ class PermsCog(CustomCog, name="Permissions"):
             del self.rules[item.id]
         else:
             self.rules[item.id] = rule
+        self.schedule_guild(item.guild)
 
         await ctx.send("Done !")
 
-    @staticmethod
-    async def _set_perms(ctx, item: RoleOrChan, to_add, to_rem):
+    async def _set_perms(self, ctx, item: RoleOrChan, to_add, to_rem):
         is_role = isinstance(item, discord.Role)
+        self.stats[item.id].api_calls += len(to_add) + len(to_rem)
 
         async for member in report_progress(
             to_rem, ctx, f"Removing {'from ' * (not is_role)}{item.name}", 1
@@ -457,6 +889,65 @@ class PermsCog(CustomCog, name="Permissions"):
         obj = self.get_role_or_channel(item, ctx.guild)
         await self.setup_auto_rule(ctx, obj, None)
 
+    @check_role(Role.MODO)
+    @perms.command("stats")
+    async def perms_stats_cmd(self, ctx: Context):
+        """(modo) Show how often each rule is evaluated, true and costly."""
+
+        rules = sorted(
+            self.rules.items(ctx.guild),
+            key=lambda x: self.stats[x[0].id].time,
+            reverse=True,
+        )
+
+        since = datetime.fromtimestamp(self.stats_since).ctime()
+        embed = discord.Embed(
+            colour=EMBED_COLOR,
+            title="Automatic rules statistics",
+            description=f"Collected since {since}, most expensive rules first.",
+        )
+
+        fields = ""
+        for item, rule in rules:
+            r = f"{item.mention}: {self.stats[item.id]}\n"
+
+            if len(fields) + len(r) >= 1024:
+                embed.add_field(name="Rules", value=fields, inline=False)
+                fields = ""
+            fields += r
+
+        if fields:
+            embed.add_field(name="Rules", value=fields, inline=False)
+
+        await ctx.send(embed=embed)
+
+    @check_role(Role.MODO)
+    @perms.command("explain")
+    async def perms_explain_cmd(self, ctx: Context, member: Member, channel_or_role):
+        """(modo) Show step by step how a rule is evaluated for a member."""
+
+        item_id = self.input_chan_or_role(channel_or_role)
+        item = self.get_role_or_channel(item_id, ctx.guild)
+        if item is None:
+            raise CozyError("Channel or role not found!")
+
+        rule = self.rules.get(item.id)
+        if rule is None:
+            raise CozyError(f"There is no automatic rule for {item.mention}.")
+
+        result, trace = rule.explain(member)
+        has = member in self.have(item)
+
+        embed = myembed(
+            f"Rule evaluation for {member.display_name}",
+            "\n".join(trace),
+            Target=item.mention,
+            Rule=rule.with_mentions(),
+            Result=result,
+            Currently=("has it" if has else "does not have it"),
+        )
+        await ctx.send(embed=embed)
+
     @check_role(Role.MODO)
     @perms.command("clear")
     async def perms_clear_cmd(self, ctx, channel: int):
@@ -9,8 +9,10 @@ __all__ = [
     "DIEGO_MENTION",
     "BOT",
     "EMBED_COLOR",
-    "FRACTAL_URL",
+    "FRACTAL_BURST",
+    "FRACTAL_CONCURRENCY",
     "FRACTAL_COOLDOWN",
+    "FRACTAL_MAX_PENDING",
     "OWNER_NAME",
     "BOT_NAME",
     "File",
@@ -43,8 +45,10 @@ DIEGO_MENTION = f"<@{OWNER}>"
 
 PREFIX = "!" if not IS_TEST_BOT else "?"
 EMBED_COLOR = 0xFF0000
-FRACTAL_URL = "https://thefractal.space/img/{seed}.png?size=640"
 FRACTAL_COOLDOWN = 42  # seconds
+FRACTAL_BURST = 2  # fractals a user can ask at once, then one per cooldown
+FRACTAL_CONCURRENCY = 2  # fractals rendered at the same time
+FRACTAL_MAX_PENDING = 3  # fractals a user can have waiting in the queue
 OWNER_NAME = "CozyFractal"
 BOT_NAME = "Botzy" if not IS_TEST_BOT else "Botzy Dev"
 
@@ -81,12 +85,16 @@ class File:
     ENGINE = TOP_LEVEL / "src" / "engine"
     COGS = TOP_LEVEL / "src" / "cogs"
     DATA = TOP_LEVEL / "data"
-    HUGS = TOP_LEVEL / "data" / "hugs"
+    HUGS = TOP_LEVEL / "data" / "hugs"  # Old text log, converted to HUGS_LOG
+    HUGS_LOG = DATA / "hugs.bin"
     REMINDERS = DATA / "reminders"
     RULES = DATA / "rules.yaml"
     CONFIG = DATA / "config.yaml"
     MEMES = DATA / "memes"
+    MEME_URLS = DATA / "meme_urls.json"
     JOKES_V2 = DATA / "jokes.yaml"
+    JOKES_JOURNAL = DATA / "jokes.journal"
+    JOKE_MESSAGES = DATA / "joke_messages.json"
     PING = DATA / "ping"
 
 
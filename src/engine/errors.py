@@ -2,7 +2,7 @@
 This module defines all the custom Exceptions used in this project.
 """
 
-__all__ = ["CozyError", "CozyOnlyError", "ConfigUndefined"]
+__all__ = ["CozyError", "CozyOnlyError", "ConfigUndefined", "WorkTimeout"]
 
 from discord.ext.commands import CommandError
 
@@ -30,6 +30,14 @@ class CozyOnlyError(CozyError):
         super().__init__("This command can only be used in the Cozy's server.")
 
 
+class WorkTimeout(CozyError):
+    """Error raised when work sent to a worker pool takes too long."""
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        super().__init__(f"This took too long, it was stopped after {timeout}s.")
+
+
 class ConfigUndefined(CozyError):
     def __init__(self, config, names):
         self.config = config
@@ -1,10 +1,14 @@
+import asyncio
+import os
 import re
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from functools import wraps
 from io import StringIO
 from math import ceil
 from pprint import pprint
 from time import time
-from typing import Tuple, TYPE_CHECKING, Union
+from typing import Dict, Optional, Tuple, TYPE_CHECKING, Union
 
 import discord
 import psutil
@@ -13,7 +17,7 @@ from discord import Member, TextChannel
 from discord.ext import commands
 from discord.ext.commands import Bot, Context, MissingRole, NoPrivateMessage
 from discord.utils import get
-from engine.errors import CozyOnlyError
+from engine.errors import CozyError, CozyOnlyError, WorkTimeout
 from src.constants import *
 
 if TYPE_CHECKING:
@@ -56,6 +60,26 @@ def mentions_to_id(s: str) -> str:
     return re.sub(r"<[@#][&!]?([0-9]{18,21})>", r"\1", s)
 
 
+DURATION_RE = re.compile(r"(?<![\w.])([0-9]+)([smhdw])(?![\w.])")
+"""A whole number of a unit, like 30d, that is not part of another token."""
+DURATION_UNITS = {"w": 7 * 24 * 3600, "d": 24 * 3600, "h": 3600, "m": 60, "s": 1}
+
+
+def parse_duration(duration: str) -> int:
+    """Convert a duration like 7d to seconds. Raises CozyError when it cannot."""
+    match = DURATION_RE.fullmatch(duration)
+    if not match:
+        raise CozyError(f"`{duration}` is not a duration, try `7d`.")
+    return int(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+
+def format_duration(seconds: int) -> str:
+    """Inverse of parse_duration: 86400 -> '1d'."""
+    for unit, length in DURATION_UNITS.items():
+        if seconds % length == 0:
+            return f"{seconds // length}{unit}"
+
+
 def remove_mentions_as(member: Member, chan: TextChannel, text: str) -> str:
     if not member.permissions_in(chan).mention_everyone:
         # Escape only @everyone/@here
@@ -111,6 +135,166 @@ def send_and_bin(f):
     return wrapped
 
 
+class WorkerPool:
+    """
+    A bounded pool of worker processes or threads, shared by the cogs.
+
+    Each worker is an executor with a single process or thread, and a job
+    waits for a free worker before it is sent to it, so its timeout only
+    counts the time it runs. When a job takes longer, WorkTimeout is raised
+    and only its worker is killed and replaced: the jobs of the other
+    workers go on. Threads cannot be killed, so a thread whose job timed
+    out is only free again when the job returns, to keep the pool bounded.
+    """
+
+    def __init__(
+        self, name, workers, processes=True, initializer=None, initargs=()
+    ):
+        self.name = name
+        self.workers = workers
+        self.processes = processes
+        self.initializer = initializer
+        self.initargs = initargs
+        self.queued = 0
+        """Number of jobs waiting for a free worker."""
+        self.running = 0
+        """Number of jobs being run by a worker."""
+        self._idle: Optional[asyncio.Queue] = None
+        """The free workers. None stands for a worker not started yet."""
+
+    def _new_executor(self) -> Executor:
+        if self.processes:
+            return ProcessPoolExecutor(
+                1, initializer=self.initializer, initargs=self.initargs
+            )
+        return ThreadPoolExecutor(
+            1,
+            thread_name_prefix=self.name,
+            initializer=self.initializer,
+            initargs=self.initargs,
+        )
+
+    async def run(self, f, *args, timeout=None, **kwargs):
+        """
+        Run f(*args, **kwargs) in a worker and return its result.
+
+        With processes, the function, arguments and result must be picklable.
+        Cancelling the call cancels the job, and stops its worker if the job
+        already started.
+        """
+
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+            for _ in range(self.workers):
+                self._idle.put_nowait(None)
+
+        self.queued += 1
+        try:
+            executor = await self._idle.get()
+        finally:
+            self.queued -= 1
+
+        if executor is None:
+            executor = self._new_executor()
+        self.running += 1
+        job = None
+        try:
+            job = executor.submit(f, *args, **kwargs)
+            return await asyncio.wait_for(asyncio.wrap_future(job), timeout)
+        except asyncio.TimeoutError:
+            if timeout is None or job.done():
+                raise  # Raised by the job itself, its worker is fine
+            executor = self.stop(executor)
+            raise WorkTimeout(timeout)
+        except BrokenProcessPool:
+            executor = self.stop(executor)
+            raise
+        except asyncio.CancelledError:
+            if not job.cancel():  # Already running
+                executor = self.stop(executor)
+            raise
+        finally:
+            self.running -= 1
+            if job is None or job.done() or self.processes:
+                self._idle.put_nowait(executor)
+            else:
+                # The thread still runs the job: it is free when the job returns
+                loop = asyncio.get_event_loop()
+                job.add_done_callback(
+                    lambda _: loop.call_soon_threadsafe(
+                        self._idle.put_nowait, executor
+                    )
+                )
+
+    def stop(self, executor: Executor) -> Optional[Executor]:
+        """
+        Kill the process of a worker, and return what takes its place.
+
+        That is None for a process, so a new one starts when it is needed,
+        and the same executor for a thread, which cannot be killed.
+        """
+
+        if not self.processes:
+            return executor
+        # noinspection PyProtectedMember
+        for process in list(executor._processes.values()):
+            process.kill()
+        executor.shutdown(wait=False)
+        return None
+
+    def __str__(self):
+        kind = "processes" if self.processes else "threads"
+        return (
+            f"{self.name}: {self.running} running, {self.queued} queued, "
+            f"{self.workers} {kind}"
+        )
+
+
+POOLS: Dict[str, WorkerPool] = {
+    "cpu": WorkerPool("cpu", max(2, (os.cpu_count() or 1) // 2)),
+    "threads": WorkerPool("threads", 4, processes=False),
+}
+"""The shared worker pools, by name. Their executors start on first use."""
+
+
+def worker_pool(name, workers=2, processes=True, initializer=None, initargs=()):
+    """Return the shared pool with this name, creating it if needed."""
+
+    if name not in POOLS:
+        POOLS[name] = WorkerPool(name, workers, processes, initializer, initargs)
+    return POOLS[name]
+
+
+async def run_cpu_bound(f, *args, pool="cpu", timeout=None, **kwargs):
+    """Run f(*args, **kwargs) in a shared worker pool, off the event loop."""
+    return await worker_pool(pool).run(f, *args, timeout=timeout, **kwargs)
+
+
+def cpu_bound(pool="cpu", timeout=None):
+    """
+    Decorator that makes a function run in a shared worker pool.
+
+    The decorated function returns an awaitable. Worker processes cannot
+    receive it, so they receive the original function under its new
+    qualified name, `<name>.__wrapped__`, through which pickle finds it.
+
+    Example:
+        >>> @cpu_bound(timeout=10)
+        ... def render(size): ...
+        >>> image = await render(640)
+    """
+
+    def decorator(f):
+        @wraps(f)
+        async def wrapper(*args, **kwargs):
+            return await run_cpu_bound(f, *args, pool=pool, timeout=timeout, **kwargs)
+
+        f.__qualname__ += ".__wrapped__"
+        return wrapper
+
+    return decorator
+
+
 async def pprint_send(ctx, *objs, **nobjs):
     embed = discord.Embed(title="Debug")
 